@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the folder scanner on a synthetic library.
+
+A directory tree is generated with the given depth, number of sub-directories per directory and
+number of media per directory. MediaInfo is replaced by a stub answering after a fixed latency, so
+the results only depend on the scanner. The following steps are timed:
+- `_scan_folder`: first scan of the library;
+- `_build_cache`: reading cache of the scanned library;
+- `_clean_directory`: clean-up of the library, when nothing was deleted;
+- `_scan_folder` again: scan of the unchanged library, repeated several times.
+
+The benchmark runs in a single transaction which is rolled back, so the database is left
+untouched. The results are printed in JSON.
+
+Usage, with the module installed in the database and the Odoo server importable:
+
+    python benchmarks/scan_benchmark.py -d DATABASE [--depth 3] [--fanout 4] [--files 20]
+        [--latency 0.005] [--workers 1] [--repeat 3] [--output results.json]
+        [-- ODOO_OPTIONS...]
+
+The Odoo options, e.g. `-c odoo.conf` or `--addons-path=...`, are given after `--`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import odoo
+from odoo import SUPERUSER_ID, api
+
+
+def generate_tree(root, depth, fanout, files):
+    """
+    Generate a synthetic library. Each directory contains `files` empty media files and `fanout`
+    sub-directories, up to `depth` levels below the root.
+
+    :param str root: path of the library
+    :param int depth: number of levels of sub-directories
+    :param int fanout: number of sub-directories per directory
+    :param int files: number of media files per directory
+    :return tuple: number of directories and of media files generated
+    """
+    dirs = [root]
+    stack = [(root, 0)]
+    while stack:
+        path, level = stack.pop()
+        for i in range(files):
+            open(os.path.join(path, "Episode {:04d}.mkv".format(i)), "wb").close()
+        if level < depth:
+            for i in range(fanout):
+                sub_path = os.path.join(path, "Season {:02d}".format(i))
+                os.mkdir(sub_path)
+                dirs.append(sub_path)
+                stack.append((sub_path, level + 1))
+    return len(dirs), len(dirs) * files
+
+
+def stub_mediainfo(latency):
+    """
+    Replace the MediaInfo query by a stub returning the infos of a typical movie after the given
+    latency. The probing processes are forked, so they inherit the stub.
+
+    :param float latency: number of seconds taken by each query
+    """
+    from odoo.addons.oovideo.models.pymediainfo import MediaInfo
+
+    def query(cls, filename, parameters, library_file=None):
+        time.sleep(latency)
+        return {
+            "General": [{"Duration": "5400000", "Format": "Matroska"}],
+            "Video": [
+                {
+                    "Height": "1080",
+                    "Width": "1920",
+                    "BitRate": "4000000",
+                    "BitRate_Nominal": None,
+                    "Format": "AVC",
+                    "Format_Profile": "High@L4.1",
+                }
+            ],
+            "Audio": [{"Language": "en", "Format": "AAC", "Format_Profile": "LC"}],
+        }
+
+    MediaInfo.query = classmethod(query)
+
+
+def timed(func, *args, **kwargs):
+    """
+    Call a function with the given arguments.
+
+    :return float: duration of the call, in seconds
+    """
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run(env, args, root):
+    """
+    Generate the library, scan it and time the scanner steps.
+
+    :param Environment env: environment of the benchmark transaction
+    :param Namespace args: parameters of the benchmark
+    :param str root: path of the library to generate
+    :return dict: results of the benchmark
+    """
+    n_dirs, n_files = generate_tree(root, args.depth, args.fanout, args.files)
+    folder = env["oovideo.folder"].create(
+        {"name": "Benchmark", "path": root, "scan_workers": args.workers}
+    )
+    Scan = env["oovideo.folder.scan"].with_context(
+        test_mode=True, recompute=False, prefetch_fields=False
+    )
+    user_id = folder.user_id.id
+
+    res = {}
+    res["scan"] = timed(Scan._scan_folder, folder.id)
+    res["build_cache"] = timed(Scan._build_cache, folder.id, user_id)
+
+    env.cr.execute("SELECT path FROM oovideo_folder WHERE user_id = %s", (user_id,))
+    folderlist = {r[0] for r in env.cr.fetchall()}
+    env.cr.execute("SELECT path FROM oovideo_media WHERE root_folder_id = %s", (folder.id,))
+    filelist = {r[0] for r in env.cr.fetchall()}
+    res["clean_directory"] = timed(Scan._clean_directory, root, user_id, folderlist, filelist)
+
+    res["rescan"] = [timed(Scan._scan_folder, folder.id) for i in range(args.repeat)]
+
+    return {
+        "parameters": {
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "files": args.files,
+            "latency": args.latency,
+            "workers": args.workers,
+            "repeat": args.repeat,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "odoo": odoo.release.version,
+            "cpu_count": os.cpu_count(),
+        },
+        "library": {"directories": n_dirs, "media": n_files, "media_scanned": len(filelist)},
+        "durations": {
+            "scan": res["scan"],
+            "build_cache": res["build_cache"],
+            "clean_directory": res["clean_directory"],
+            "rescan": res["rescan"],
+            "rescan_median": statistics.median(res["rescan"]) if res["rescan"] else None,
+        },
+        "files_per_second": {
+            "scan": n_files / res["scan"] if res["scan"] else None,
+            "rescan": n_files / statistics.median(res["rescan"]) if res["rescan"] else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the oovideo folder scanner")
+    parser.add_argument("-d", "--database", required=True, help="database with oovideo installed")
+    parser.add_argument("--depth", type=int, default=3, help="levels of sub-directories")
+    parser.add_argument("--fanout", type=int, default=4, help="sub-directories per directory")
+    parser.add_argument("--files", type=int, default=20, help="media files per directory")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per MediaInfo query")
+    parser.add_argument("--workers", type=int, default=1, help="probing processes")
+    parser.add_argument("--repeat", type=int, default=3, help="number of scans without change")
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    parser.add_argument("odoo_args", nargs="*", help="options of the Odoo server, after --")
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(args.odoo_args + ["-d", args.database])
+    stub_mediainfo(args.latency)
+
+    root = tempfile.mkdtemp(prefix="oovideo_benchmark_")
+    try:
+        registry = odoo.registry(args.database)
+        with api.Environment.manage(), registry.cursor() as cr:
+            try:
+                results = run(api.Environment(cr, SUPERUSER_ID, {}), args, root)
+            finally:
+                cr.rollback()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,199 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import mimetypes
 import os
-from tempfile import NamedTemporaryFile
 
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import Forbidden, NotFound, ServiceUnavailable
+from werkzeug.urls import url_quote
 from werkzeug.wrappers import Response
 from werkzeug.wsgi import wrap_file
 
 from odoo import http
 from odoo.http import request
 
-try:
-    from webvtt import webvtt
-except ImportError:
-    webvtt = None
-
+from ..models.oovideo_cache import FileCache
+from ..models.oovideo_scheduler import scheduler
 
 _logger = logging.getLogger(__name__)
 
+# Cache policies of the routes. The content is private since it requires an authenticated user.
+# - the playlists and subtitles are cheap to validate, but may change with a new scan
+# - a media playlist embeds a new playback session identifier, so it is never reused: two players
+#   must not share a session
+# - the direct play files are validated with their modification date
+# - a segment never changes for given parameters, since the modification date of the media is
+#   part of its ETag
+CACHE_CONTROL_PLAYLIST = "private, no-cache"
+CACHE_CONTROL_SESSION = "private, no-store"
+CACHE_CONTROL_FILE = "private, max-age=3600"
+CACHE_CONTROL_SEGMENT = "private, max-age=604800, immutable"
+
 
 class VideoController(http.Controller):
+    def _get_etag(self, *args, **kwargs):
+        """
+        Build an ETag from the given values and request parameters. The session identifier is
+        excluded, since it does not change the content.
+
+        :return str: ETag
+        """
+        params = sorted((k, str(v)) for k, v in kwargs.items() if k != "sid")
+        return FileCache.make_key(*(args + (params,)))
+
+    def _not_modified(self, etag, cache_control):
+        """
+        Check the validator sent by the client. This must be called before doing any work, so a
+        request for an up-to-date content is answered right away.
+
+        :param str etag: ETag of the current content
+        :param str cache_control: cache policy of the route
+        :return Response: empty response with status 304, or None if the content was modified
+        """
+        if etag not in request.httprequest.if_none_match:
+            return None
+        rv = Response(status=304)
+        return self._set_cache_headers(rv, etag, cache_control)
+
+    def _set_cache_headers(self, rv, etag, cache_control, last_modified=None):
+        rv.set_etag(etag)
+        rv.headers["Cache-Control"] = cache_control
+        if last_modified:
+            rv.last_modified = last_modified
+        return rv
+
+    def _send_media(self, path, mimetype=None):
+        """
+        Send a media file as is, for direct play. Range requests are supported, so the player
+        can seek without downloading the whole file. The file is read in chunks and streamed by
+        the Odoo worker.
+
+        If configured, the transfer is offloaded to the reverse proxy thanks to the
+        `X-Accel-Redirect` or `X-Sendfile` header. In both cases the path is URL-encoded, so
+        names which are not latin-1 can be sent in a header: the proxy must decode it, which is
+        the default of nginx and of Apache `mod_xsendfile`.
+
+        :param str path: path of the media file
+        :param str mimetype: mimetype of the file, guessed from the extension if not set
+        :return Response: response sending the file
+        """
+        if not os.path.isfile(path):
+            raise NotFound()
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        headers = [
+            (
+                "Content-Disposition",
+                "inline; filename*=UTF-8''%s" % url_quote(os.path.basename(path)),
+            )
+        ]
+
+        ICP = request.env["ir.config_parameter"].sudo()
+        mode = ICP.get_param("oovideo.sendfile_mode")
+        if mode == "x-accel-redirect":
+            prefix = ICP.get_param("oovideo.sendfile_prefix", "/oovideo_media").rstrip("/")
+            headers.append(("X-Accel-Redirect", prefix + url_quote(path)))
+            return Response(mimetype=mimetype, headers=headers)
+        elif mode == "x-sendfile":
+            headers.append(("X-Sendfile", url_quote(path)))
+            return Response(mimetype=mimetype, headers=headers)
+
+        f = open(path, "rb")
+        st = os.fstat(f.fileno())
+        data = wrap_file(request.httprequest.environ, f)
+        rv = Response(data, mimetype=mimetype, headers=headers, direct_passthrough=True)
+        etag = self._get_etag(path, st.st_mtime, st.st_size)
+        self._set_cache_headers(rv, etag, CACHE_CONTROL_FILE, st.st_mtime)
+        return rv.make_conditional(
+            request.httprequest, accept_ranges=True, complete_length=st.st_size
+        )
+
     @http.route(["/oovideo/stream/<int:media_id>.<string:vformat>"], type="http", auth="user")
     def stream(self, media_id, vformat, **kwargs):
         media = request.env["oovideo.media"].browse([media_id])
-        if vformat == "mp4":
-            return http.send_file(media.path, as_attachment=True)
+        if vformat != "m3u8":
+            return self._send_media(media.path, media._get_format().mimetype or None)
+        # A media playlist embeds a new session identifier, it is always built again
+        if not (kwargs.get("res") == "auto" and media._get_renditions()):
+            generator = media.oovideo_stream(**kwargs)
+            data = wrap_file(request.httprequest.environ, generator)
+            rv = Response(data, mimetype="application/x-mpegurl", direct_passthrough=True)
+            rv.headers["Cache-Control"] = CACHE_CONTROL_SESSION
+            return rv
+
+        # The master playlist is validated against the transcoder state, like the segments
+        transcoder = request.env.ref("oovideo.oovideo_transcoder_0")
+        etag = self._get_etag(
+            "playlist",
+            media.id,
+            media.last_modification,
+            transcoder.session_mode,
+            str(transcoder.write_date),
+            **kwargs
+        )
+        rv = self._not_modified(etag, CACHE_CONTROL_PLAYLIST)
+        if rv:
+            return rv
         generator = media.oovideo_stream(**kwargs)
         data = wrap_file(request.httprequest.environ, generator)
-        return Response(data, mimetype="application/x-mpegurl", direct_passthrough=True)
+        rv = Response(data, mimetype="application/x-mpegurl", direct_passthrough=True)
+        return self._set_cache_headers(rv, etag, CACHE_CONTROL_PLAYLIST)
 
     @http.route(["/oovideo/trans/<int:media_id>.ts"], type="http", auth="user")
     def trans(self, media_id, **kwargs):
         transcoder = request.env["oovideo.transcoder"].env.ref("oovideo.oovideo_transcoder_0")
-        generator = transcoder.transcode(media_id, **kwargs).stdout
+        media = request.env["oovideo.media"].browse([media_id])
+        etag = self._get_etag(
+            "segment",
+            media.id,
+            media.last_modification,
+            transcoder.id,
+            str(transcoder.write_date),
+            **kwargs
+        )
+        rv = self._not_modified(etag, CACHE_CONTROL_SEGMENT)
+        if rv:
+            return rv
+        try:
+            data = transcoder.transcode_segment(media_id, **kwargs)
+        except TimeoutError:
+            raise ServiceUnavailable()
         mimetype = transcoder.output_format.mimetype
+        rv = Response(data, mimetype=mimetype, direct_passthrough=True)
+        return self._set_cache_headers(rv, etag, CACHE_CONTROL_SEGMENT)
 
-        data = wrap_file(request.httprequest.environ, generator)
-        return Response(data, mimetype=mimetype, direct_passthrough=True)
+    @http.route(["/oovideo/preview/<int:media_id>.<string:ext>"], type="http", auth="user")
+    def preview(self, media_id, ext, **kwargs):
+        media = request.env["oovideo.media"].browse([media_id])
+        preview = media._get_preview()
+        if not preview or ext not in ("jpg", "vtt"):
+            raise NotFound()
+        path = preview[0] if ext == "jpg" else preview[1]
+        etag = self._get_etag("preview", media.id, media.last_modification, ext)
+        rv = self._not_modified(etag, CACHE_CONTROL_FILE)
+        if rv:
+            return rv
+        rv = http.send_file(path, mimetype="image/jpeg" if ext == "jpg" else "text/vtt")
+        return self._set_cache_headers(rv, etag, CACHE_CONTROL_FILE)
+
+    @http.route(["/oovideo/stats"], type="http", auth="user")
+    def stats(self, **kwargs):
+        if not request.env.user.has_group("base.group_system"):
+            raise Forbidden()
+        return Response(json.dumps(scheduler.stats()), mimetype="application/json")
 
     @http.route(["/oovideo/sub/<int:media_id>"], type="http", auth="user")
     def sub(self, media_id, **kwargs):
         media = request.env["oovideo.media"].browse([media_id])
-        sub = os.path.join(media.folder_id.path, kwargs.get("sub", "").split(os.sep)[-1])
-        if os.path.isfile(sub):
-            with NamedTemporaryFile(mode="w", encoding="utf-8", delete=False) as sub_tmp:
-                sub_send = sub_tmp.name
-                sub_ext = os.path.splitext(sub)[1]
-                if sub_ext == ".srt" and webvtt:
-                    webvtt.WebVTT().from_srt(sub).write(sub_tmp)
-                elif sub_ext == ".sbv" and webvtt:
-                    webvtt.WebVTT().from_sbv(sub).write(sub_tmp)
-                elif sub_ext == ".vtt":
-                    sub_send = sub
-                else:
-                    raise NotFound()
-                return http.send_file(sub_send, mimetype="text/vtt")
+        subtitle = media.subtitle_ids.filtered(lambda s: s.name == kwargs.get("sub"))[:1]
+        if subtitle and os.path.isfile(subtitle.path):
+            st = os.stat(subtitle.path)
+            etag = self._get_etag("sub", subtitle.path, st.st_mtime, st.st_size)
+            rv = self._not_modified(etag, CACHE_CONTROL_FILE)
+            if rv:
+                return rv
+            sub_send = subtitle._get_vtt_path()
+            if sub_send:
+                rv = http.send_file(sub_send, mimetype="text/vtt")
+                return self._set_cache_headers(rv, etag, CACHE_CONTROL_FILE, st.st_mtime)
         raise NotFound()
@@ -5,4 +5,6 @@ from . import oovideo_folder
 from . import oovideo_folder_scan
 from . import oovideo_format
 from . import oovideo_media
+from . import oovideo_media_error
+from . import oovideo_subtitle
 from . import oovideo_transcoder
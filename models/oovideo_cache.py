@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+
+def get_cache_dir(dbname, name):
+    """
+    Return the directory used to store the cache `name` of the database `dbname`. The directory
+    is located in the Odoo data directory, next to the filestore.
+
+    :param str dbname: name of the database
+    :param str name: name of the cache
+    :return str: path of the cache directory
+    """
+    return os.path.join(config["data_dir"], "oovideo", dbname, name)
+
+
+class FileCacheWriter(object):
+    """
+    Write a cache entry in a temporary file. The entry only becomes visible to readers once
+    `commit` is called, thanks to an atomic rename. If the writer is closed before being
+    committed, the temporary file is simply removed.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.tmp_dir, suffix=cache.suffix)
+        self.fd = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.fd.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        if self.fd is None:
+            return
+        self.fd.close()
+        self.fd = None
+        path = self.cache.path(self.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp_path, path)
+        self.cache._add_size(self.size)
+
+    def abort(self):
+        if self.fd is None:
+            return
+        self.fd.close()
+        self.fd = None
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+class FileCache(object):
+    """
+    A content-addressed cache stored on disk. Entries are identified by a key built from any
+    hashable data, and are evicted in LRU order when the total size exceeds the size budget. The
+    access time is tracked thanks to the modification time of the files, so the cache can be
+    shared by several Odoo workers.
+    """
+
+    # Approximate size of each cache directory, shared by all threads of the process
+    _sizes = {}
+    _lock = threading.Lock()
+
+    def __init__(self, root, max_size, suffix=""):
+        """
+        :param str root: directory of the cache
+        :param int max_size: size budget of the cache, in bytes. No limit if lower or equal to 0.
+        :param str suffix: extension of the cache files
+        """
+        self.root = root
+        self.max_size = max_size
+        self.suffix = suffix
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*args):
+        """
+        Build a cache key from the given arguments.
+
+        :return str: hexadecimal key
+        """
+        return hashlib.sha1(repr(args).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """
+        Look for an entry in the cache. On a hit, the entry is marked as recently used.
+
+        :param str key: key of the entry
+        :return str: path of the cached file, or None if there is no such entry
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def writer(self, key):
+        """
+        Create a writer for the given key. The caller must call `commit` or `abort` on the writer.
+
+        :param str key: key of the entry
+        :return FileCacheWriter: writer of the entry
+        """
+        return FileCacheWriter(self, key)
+
+    def put(self, key, src_path):
+        """
+        Copy an existing file in the cache.
+
+        :param str key: key of the entry
+        :param str src_path: path of the file to copy
+        :return str: path of the cached file
+        """
+        writer = self.writer(key)
+        try:
+            with open(src_path, "rb") as f:
+                shutil.copyfileobj(f, writer)
+            writer.commit()
+        finally:
+            writer.abort()
+        return self.path(key)
+
+    def _entries(self):
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name == "tmp":
+                continue
+            for sub_entry in os.scandir(entry.path):
+                try:
+                    stat = sub_entry.stat()
+                except OSError:
+                    continue
+                yield sub_entry.path, stat.st_size, stat.st_mtime
+
+    def _add_size(self, size):
+        with self._lock:
+            if self.root not in self._sizes:
+                self._sizes[self.root] = sum(e[1] for e in self._entries())
+            else:
+                self._sizes[self.root] += size
+            total = self._sizes[self.root]
+        if self.max_size > 0 and total > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in 90 % of its budget, so we
+        do not need to evict at every new entry.
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(e[1] for e in entries)
+            target = self.max_size * 0.9
+            for path, size, mtime in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._sizes[self.root] = total
+        _logger.debug('Cache "%s" evicted, size is now %s bytes', self.root, total)
+
+    def prune(self, max_age):
+        """
+        Remove the entries which were not used for a given time, as well as the temporary files
+        left by the writers which were never closed, e.g. because the server was stopped.
+
+        :param int max_age: maximum age of the entries, in seconds
+        """
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for path, size, mtime in list(self._entries()):
+                if mtime < now - max_age:
+                    try:
+                        os.unlink(path)
+                        removed += size
+                    except OSError:
+                        pass
+            for entry in os.scandir(self.tmp_dir):
+                try:
+                    if entry.stat().st_mtime < now - min(max_age, 86400):
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+            if self.root in self._sizes:
+                self._sizes[self.root] -= removed
+        _logger.debug('Cache "%s" pruned, %s bytes removed', self.root, removed)
@@ -3,6 +3,8 @@
 from odoo import api, fields, models
 from odoo.release import version
 
+from .oovideo_scheduler import scheduler
+
 
 class VideoConfigSettings(models.TransientModel):
     _name = "oovideo.config.settings"
@@ -18,17 +20,66 @@ class VideoConfigSettings(models.TransientModel):
         [("inactive", "Inactive (user specific)"), ("active", "Active (shared amongst all users)")],
         string="Folder Sharing",
     )
+    scan_batch_size = fields.Integer(
+        "Scan Batch Size",
+        default=100,
+        config_parameter="oovideo.scan_batch_size",
+        help="Number of medias written at once in the database while scanning, followed by a "
+        "commit",
+    )
+    probe_timeout = fields.Integer(
+        "Probe Timeout (s)",
+        default=120,
+        config_parameter="oovideo.probe_timeout",
+        help="Maximum duration of the reading of a media while scanning. The files exceeding it "
+        "are read again at the next scan.",
+    )
+    keyframe_timeout = fields.Integer(
+        "Keyframe Indexing Timeout (s)",
+        default=1800,
+        config_parameter="oovideo.keyframe_timeout",
+        help="Maximum duration of the indexing of the keyframes of a media, after the scan. The "
+        "segments of the media exceeding it are not aligned on the keyframes.",
+    )
+    segment_cache_size = fields.Integer(
+        "Segment Cache Size (MB)",
+        default=2048,
+        config_parameter="oovideo.segment_cache_size",
+        help="Maximum disk space used to keep transcoded segments. The least recently used "
+        "segments are removed when the limit is reached. Set to 0 for no limit.",
+    )
+    sendfile_mode = fields.Selection(
+        [("x-accel-redirect", "X-Accel-Redirect (nginx)"), ("x-sendfile", "X-Sendfile (Apache)")],
+        string="Direct Play Offload",
+        config_parameter="oovideo.sendfile_mode",
+        help="Let the reverse proxy send the media files in direct play, instead of the Odoo "
+        "server. The reverse proxy must be configured accordingly.",
+    )
+    sendfile_prefix = fields.Char(
+        "Offload Location",
+        default="/oovideo_media",
+        config_parameter="oovideo.sendfile_prefix",
+        help="Internal location of nginx serving the file system, prepended to the path of the "
+        "media in the X-Accel-Redirect header",
+    )
+    transcode_running = fields.Integer("Running Transcodings", readonly=True)
+    transcode_queued = fields.Integer(
+        "Queued Transcodings",
+        readonly=True,
+        help="Number of transcodings waiting for a free slot in this server process",
+    )
     version = fields.Char("Version", readonly=True)
 
     @api.model
     def get_values(self):
         res = super(VideoConfigSettings, self).get_values()
         cron = (self.env.ref("oovideo.oovideo_scan_folder")).mapped("active")
-        folder_sharing = (
-            self.env.ref("oovideo.oovideo_folder") + self.env.ref("oovideo.oovideo_media")
-        ).mapped("perm_read")
+        folder_sharing = self._get_sharing_rules().mapped("perm_read")
         res["cron"] = "active" if all([c for c in cron]) else "inactive"
         res["folder_sharing"] = "inactive" if all([c for c in folder_sharing]) else "active"
+        stats = scheduler.stats()
+        res["transcode_running"] = sum(stats["running"].values())
+        res["transcode_queued"] = sum(stats["queued"].values())
         res["version"] = version
         return res
 
@@ -37,6 +88,12 @@ class VideoConfigSettings(models.TransientModel):
         # Activate/deactive ir.cron
         (self.env.ref("oovideo.oovideo_scan_folder")).write({"active": bool(self.cron == "active")})
         # Set folder sharing
-        (self.env.ref("oovideo.oovideo_folder") + self.env.ref("oovideo.oovideo_media")).write(
-            {"perm_read": bool(self.folder_sharing == "inactive")}
+        self._get_sharing_rules().write({"perm_read": bool(self.folder_sharing == "inactive")})
+
+    def _get_sharing_rules(self):
+        return (
+            self.env.ref("oovideo.oovideo_folder")
+            + self.env.ref("oovideo.oovideo_media")
+            + self.env.ref("oovideo.oovideo_media_error")
+            + self.env.ref("oovideo.oovideo_subtitle")
         )
@@ -3,11 +3,65 @@
 import json
 import logging
 import os
+import threading
+import time
+from itertools import groupby
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
+from odoo.tools.sql import create_index
+
+from .oovideo_watcher import ensure_watcher
 
 _logger = logging.getLogger(__name__)
 
+# Number of entries returned by a browsing request
+BROWSE_LIMIT = 200
+# Maximum number of files shown in the preview of a folder, in total and per directory
+PREVIEW_MAX_FILES = 30
+PREVIEW_MAX_FILES_DIR = 4
+# Maximum number of seconds spent walking a folder to build its preview
+PREVIEW_TIME_BUDGET = 5
+
+
+def format_preview(root, files_by_dir):
+    """
+    Format the preview of the content of a folder.
+
+    :param str root: path of the folder
+    :param files_by_dir: iterator of tuples (directory, list of file names), in display order
+    :return str: preview, False if there is no file
+    """
+    lines = []
+    for rootdir, file_names in files_by_dir:
+        for fn in file_names[:PREVIEW_MAX_FILES_DIR]:
+            lines.append(os.path.join(rootdir.replace(root, ""), fn))
+        if len(file_names) > PREVIEW_MAX_FILES_DIR:
+            lines.append("...")
+        if len(lines) > PREVIEW_MAX_FILES:
+            break
+    return "".join("{}\n".format(line) for line in lines) or False
+
+
+def walk_preview(root, extensions, budget=PREVIEW_TIME_BUDGET):
+    """
+    Walk in a folder to list the files of its preview. The walk stops once the time budget is
+    exceeded, so a slow network share does not block for long.
+
+    :param str root: path of the folder
+    :param set extensions: allowed file extensions
+    :param float budget: maximum number of seconds spent walking
+    :return: iterator of tuples (directory, list of file names)
+    """
+    deadline = time.monotonic() + budget
+    for rootdir, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        file_names = sorted(fn for fn in filenames if fn.split(".")[-1].lower() in extensions)
+        if file_names:
+            yield rootdir, file_names
+        if time.monotonic() > deadline:
+            _logger.debug('Time budget exceeded while building the preview of "%s"', root)
+            return
+
 
 class VideoFolder(models.Model):
     _name = "oovideo.folder"
@@ -23,11 +77,47 @@ class VideoFolder(models.Model):
         help="Exclude this folder from the automatized scheduled scan. Useful if the folder is not "
         "always accessible, e.g. linked to an external drive.",
     )
+    watch = fields.Boolean(
+        "Watch Changes",
+        default=False,
+        help="Detect the changes in the folder as they happen, and update the library within "
+        "seconds. Requires the inotify_simple Python library, on Linux only. The scheduled scan "
+        "is still executed.",
+    )
+    generate_previews = fields.Boolean(
+        "Generate Previews",
+        default=False,
+        help="Generate thumbnails of the new and modified media in the background, shown while "
+        "seeking in the player",
+    )
+    index_keyframes = fields.Boolean(
+        "Index Keyframes",
+        default=False,
+        help="Build an index of the keyframes of each media while scanning. The streaming "
+        "segments are then aligned on the keyframes, which makes seeking faster. Scanning is "
+        "slower since each file must be read entirely.",
+    )
+    hash_files = fields.Boolean(
+        "Detect Moves Across Disks",
+        default=False,
+        help="Compute a hash of samples of each media while scanning. A media moved to another "
+        "disk is then recognized, and is not probed again. Without it, only the media moved on "
+        "the same disk are recognized.",
+    )
+    scan_workers = fields.Integer(
+        "Scan Workers",
+        default=1,
+        help="Number of files probed in parallel while scanning. A higher value speeds up the "
+        "first scan of a large library, especially on network shares or several disks.",
+    )
     last_scan = fields.Datetime("Last Scanned")
     last_scan_duration = fields.Integer("Scan Duration (s)")
-    parent_id = fields.Many2one("oovideo.folder", string="Parent Folder", ondelete="cascade")
+    parent_id = fields.Many2one(
+        "oovideo.folder", string="Parent Folder", index=True, ondelete="cascade"
+    )
     child_ids = fields.One2many("oovideo.folder", "parent_id", string="Child Folders")
     media_ids = fields.One2many("oovideo.media", "folder_id", string="Media")
+    error_ids = fields.One2many("oovideo.media.error", "root_folder_id", string="Unreadable Files")
     user_id = fields.Many2one(
         "res.users",
         string="User",
@@ -43,41 +133,88 @@ class VideoFolder(models.Model):
         help='When a folder is being scanned, it is flagged as "locked". It might be necessary to '
         "unlock it manually if scanning has failed or has been interrupted.",
     )
-    root_preview = fields.Text("Preview Folder Content", compute="_compute_root_preview")
+    root_preview = fields.Text(
+        "Preview Folder Content",
+        readonly=True,
+        help="Refreshed in the background when the path is set, and at each scan",
+    )
+    browse_generation = fields.Integer(
+        "Listing Generation",
+        default=0,
+        readonly=True,
+        help="Incremented when the content of the folder changes, so its cached listing is built "
+        "again",
+    )
     path_name = fields.Char("Folder Name", compute="_compute_path_name")
 
     _sql_constraints = [
         ("oovideo_folder_path_uniq", "unique(path, user_id)", "Folder path must be unique!")
     ]
 
-    @api.depends("path")
-    def _compute_root_preview(self):
-        ALLOWED_FILE_EXTENSIONS = self.env["oovideo.folder.scan"].ALLOWED_FILE_EXTENSIONS
-        for folder in self:
-            if not folder.root or not folder.path:
-                folder.root_preview = False
-                continue
-            i = 0
-            fn_paths = ""
-            for rootdir, dirnames, filenames in os.walk(folder.path):
-                ii = 0
-                for fn in filenames:
-                    # Check file extension
-                    fn_ext = fn.split(".")[-1]
-                    if fn_ext and fn_ext.lower() not in ALLOWED_FILE_EXTENSIONS:
-                        continue
-
-                    fn_paths += "{}\n".format(os.path.join(rootdir.replace(folder.path, ""), fn))
-                    i += 1
-                    ii += 1
-                    if ii > 3:
-                        fn_paths += "...\n"
-                        break
-                if i > 30:
-                    break
-            if not fn_paths:
-                fn_paths = _("No track found")
-            folder.root_preview = fn_paths
+    def _refresh_root_preview(self):
+        """
+        Refresh the preview of the root folders from the media found by the last scan. The first
+        files of each directory are read from the database, without accessing the disk.
+        """
+        for folder in self.filtered("root"):
+            self.env.cr.execute(
+                """
+                SELECT path FROM (
+                    SELECT path, row_number() OVER (PARTITION BY folder_id ORDER BY path) AS n
+                    FROM oovideo_media WHERE root_folder_id = %s
+                ) AS m WHERE n <= %s
+                """,
+                (folder.id, PREVIEW_MAX_FILES_DIR + 1),
+            )
+            paths = sorted(os.path.split(r[0]) for r in self.env.cr.fetchall())
+            files_by_dir = (
+                (rootdir, [p[1] for p in group])
+                for rootdir, group in groupby(paths, key=lambda p: p[0])
+            )
+            folder.root_preview = format_preview(folder.path, files_by_dir) or _("No track found")
+
+    def _refresh_root_preview_th(self):
+        """
+        Refresh the preview of the root folders in a new thread, once the current transaction is
+        committed. The folders are walked on the disk with a bounded time budget, since they were
+        not scanned yet. The previous preview is shown in the meantime.
+        """
+        folders = [(f.id, f.path) for f in self.filtered("root")]
+        if not folders:
+            return
+        thread = threading.Thread(target=self.sudo()._walk_root_preview, args=(folders,))
+        self.env.cr.after("commit", thread.start)
+
+    def _walk_root_preview(self, folders):
+        """
+        Walk in the root folders to build their preview, and write it.
+
+        :param list folders: tuples (ID, path) of the folders
+        """
+        extensions = self.env["oovideo.folder.scan"].ALLOWED_FILE_EXTENSIONS
+        previews = {}
+        for folder_id, path in folders:
+            try:
+                previews[folder_id] = format_preview(path, walk_preview(path, extensions))
+            except OSError:
+                previews[folder_id] = False
+        # The cursor is opened once the disk is walked, so it is not held meanwhile
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            self = self.with_env(self.env(cr))
+            for folder_id, path in folders:
+                folder = self.browse(folder_id).exists()
+                # The path might have changed meanwhile
+                if folder and folder.path == path:
+                    folder.root_preview = previews[folder_id] or _("No track found")
+
+    def init(self):
+        # Support the prefix searches on the path, used to clean a directory
+        create_index(
+            self.env.cr,
+            "oovideo_folder_user_id_path_index",
+            self._table,
+            ["user_id", "path text_pattern_ops"],
+        )
 
     @api.depends("path")
     def _compute_path_name(self):
@@ -91,16 +228,57 @@ class VideoFolder(models.Model):
     def create(self, vals):
         if "path" in vals and vals.get("root", True):
             vals["path"] = os.path.normpath(vals["path"])
-        return super(VideoFolder, self).create(vals)
+        res = super(VideoFolder, self).create(vals)
+        res.parent_id._bump_browse_generation()
+        if res.root:
+            res._refresh_root_preview_th()
+        return res
+
+    def unlink(self):
+        self.mapped("parent_id")._bump_browse_generation()
+        return super(VideoFolder, self).unlink()
 
     def write(self, vals):
+        if "path" in vals or "parent_id" in vals:
+            # The folders are shown in the listing of their former parent
+            self._bump_browse_generation()
         if "path" in vals:
             vals["path"] = os.path.normpath(vals["path"])
             folders = self | self.search([("id", "child_of", self.ids)])
             folders.write({"last_modification": 0})
             tracks = folders.mapped("media_ids")
             tracks.write({"last_modification": 0})
-        return super(VideoFolder, self).write(vals)
+        elif vals.get("index_keyframes"):
+            # The existing media must be probed again to index their keyframes
+            to_index = self.filtered(lambda f: not f.index_keyframes)
+            if to_index:
+                folders = to_index | self.search([("id", "child_of", to_index.ids)])
+                folders.write({"last_modification": 0})
+                tracks = self.env["oovideo.media"].search([("root_folder_id", "in", to_index.ids)])
+                tracks.sudo().write({"last_modification": 0})
+        res = super(VideoFolder, self).write(vals)
+        if "path" in vals or "parent_id" in vals:
+            self._bump_browse_generation()
+        if "path" in vals:
+            self._refresh_root_preview_th()
+        return res
+
+    def _bump_browse_generation(self):
+        """
+        Invalidate the cached listings of the folders, after their content changed. The listings
+        of their parent folders are invalidated as well, since they show the number of entries of
+        the folders.
+        """
+        if not self.ids:
+            return
+        self.env.cr.execute(
+            """
+            UPDATE oovideo_folder SET browse_generation = COALESCE(browse_generation, 0) + 1
+            WHERE id IN %s OR id IN (SELECT parent_id FROM oovideo_folder WHERE id IN %s)
+            """,
+            (tuple(self.ids), tuple(self.ids)),
+        )
+        self.invalidate_cache(["browse_generation"])
 
     def action_scan_folder(self):
         """
@@ -122,6 +300,7 @@ class VideoFolder(models.Model):
             folders.sudo().write({"last_modification": 0})
             media = self.env["oovideo.media"].search([("root_folder_id", "=", folder_id)])
             media.sudo().write({"last_modification": 0})
+            self.sudo().error_ids.unlink()
             self.env.cr.commit()
             self.env["oovideo.folder.scan"].scan_folder_th(folder_id)
 
@@ -134,20 +313,112 @@ class VideoFolder(models.Model):
                 _logger.info("Error while scanning folder ID %s", folder.id)
                 continue
 
-    def oovideo_browse(self):
+    @api.model
+    def cron_watch_folder(self):
+        """
+        Start the watcher of the folders in the current process, if it is not already running. The
+        watcher then follows the changes of the `watch` flag by itself.
+        """
+        if not self.search_count([("root", "=", True), ("watch", "=", True)]):
+            return
+        if not ensure_watcher(self.env.cr.dbname):
+            _logger.warning("Cannot watch folders: the inotify_simple library is not installed")
+
+    def _browse_query(self, model, domain, select, offset, limit):
+        """
+        Read a page of records ordered by path, directly in SQL. The access rules are applied like
+        in a search, so only the records visible by the user are returned.
+
+        :param str model: name of the model to read
+        :param list domain: domain of the records
+        :param str select: columns to read, the table being named after the model
+        :param int offset: number of records to skip
+        :param int limit: maximum number of records to read
+        :return tuple: list of rows, and total number of records
+        """
+        Model = self.env[model]
+        query = Model._where_calc(domain)
+        Model._apply_ir_rules(query, "read")
+        from_clause, where_clause, params = query.get_sql()
+        where = "WHERE %s" % where_clause if where_clause else ""
+
+        self.env.cr.execute("SELECT count(1) FROM {} {}".format(from_clause, where), params)
+        count = self.env.cr.fetchone()[0]
+        rows = []
+        if limit > 0 and offset < count:
+            query = 'SELECT {} FROM {} {} ORDER BY "{}".path LIMIT %s OFFSET %s'.format(
+                select, from_clause, where, Model._table
+            )
+            self.env.cr.execute(query, params + [limit, offset])
+            rows = self.env.cr.fetchall()
+        return rows, count
+
+    @tools.ormcache("self.env.uid", "folder_id", "generation", "offset", "limit")
+    def _oovideo_browse(self, folder_id, generation, offset, limit):
+        """
+        Build the listing of a folder. It is cached until the content of the folder changes, which
+        increments its generation. The listings of the previous generations are not used anymore,
+        and are evicted from the cache eventually.
+
+        :param int folder_id: ID of the folder, the root folders are listed if not set
+        :param generation: generation of the folder, or of all root folders if not set
+        :param int offset: number of entries to skip, the sub-folders being listed first
+        :param int limit: maximum number of entries
+        :return str: JSON listing of the folder
+        """
+        folder = self.browse(folder_id)
         res = {}
-        if self.root or self.parent_id:
-            res["parent_id"] = {"id": self.parent_id.id, "name": self.path_name or ""}
-        if self:
-            res["current_id"] = {"id": self.id, "name": self.path}
-            res["child_ids"] = [{"id": c.id, "name": c.path_name} for c in self.child_ids]
+        if folder.root or folder.parent_id:
+            res["parent_id"] = {"id": folder.parent_id.id, "name": folder.path_name or ""}
+        if folder:
+            res["current_id"] = {"id": folder.id, "name": folder.path}
+            domain = [("parent_id", "=", folder.id)]
         else:
-            res["child_ids"] = [
-                {"id": c.id, "name": c.path_name} for c in self.search([("root", "=", True)])
-            ]
-        res["media_ids"] = [
-            {"id": t.id, "name": t.path.split(os.sep)[-1]}
-            for t in self.media_ids.sorted(key="path")
+            domain = [("root", "=", True)]
+
+        # Number of entries of each sub-folder
+        select = """
+            oovideo_folder.id, oovideo_folder.path, oovideo_folder.root,
+            (SELECT count(1) FROM oovideo_folder c WHERE c.parent_id = oovideo_folder.id)
+            + (SELECT count(1) FROM oovideo_media m WHERE m.folder_id = oovideo_folder.id)
+        """
+        rows, res["child_count"] = self._browse_query(
+            "oovideo.folder", domain, select, offset, limit
+        )
+        res["child_ids"] = [
+            {"id": r[0], "name": r[1] if r[2] else r[1].split(os.sep)[-1], "count": r[3]}
+            for r in rows
         ]
 
+        # The media follow the sub-folders
+        rows, res["media_count"] = [], 0
+        if folder:
+            rows, res["media_count"] = self._browse_query(
+                "oovideo.media",
+                [("folder_id", "=", folder.id)],
+                "oovideo_media.id, oovideo_media.path",
+                max(offset - res["child_count"], 0),
+                limit - len(res["child_ids"]),
+            )
+        res["media_ids"] = [{"id": r[0], "name": r[1].split(os.sep)[-1]} for r in rows]
         return json.dumps(res)
+
+    def oovideo_browse(self, offset=0, limit=BROWSE_LIMIT):
+        """
+        List the content of a folder, by pages. The sub-folders come first, followed by the media,
+        both ordered by path.
+
+        :param int offset: number of entries to skip
+        :param int limit: maximum number of entries
+        :return str: JSON listing of the folder, with the total number of sub-folders in
+            `child_count` and of media in `media_count`
+        """
+        if self:
+            generation = self.browse_generation
+        else:
+            # The root folders are listed: a root folder created or deleted changes the generation
+            self.env.cr.execute(
+                "SELECT id, browse_generation FROM oovideo_folder WHERE root = true ORDER BY id"
+            )
+            generation = tuple(self.env.cr.fetchall())
+        return self._oovideo_browse(self.id, generation, max(int(offset), 0), max(int(limit), 1))
@@ -1,17 +1,182 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
+import signal
+import stat
+import subprocess
 import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
 from odoo import _, api, fields, models
 
+from .oovideo_subtitle import SUBTITLE_EXTENSIONS, guess_language
+from . import pymediainfo
 from .pymediainfo import MediaInfo
 
 _logger = logging.getLogger(__name__)
 
 
+# Parameters read by MediaInfo for each stream kind
+PROBE_PARAMETERS = {
+    "General": ["Duration", "Format"],
+    "Video": ["Height", "Width", "BitRate", "BitRate_Nominal", "Format", "Format_Profile"],
+    "Audio": ["Language", "Format", "Format_Profile"],
+}
+
+# Default maximum number of seconds the probing of a file may take
+PROBE_TIMEOUT = 120
+# Default maximum number of seconds the indexing of the keyframes of a file may take
+KEYFRAME_TIMEOUT = 1800
+# Size of each sample read to compute the content hash of a file
+HASH_SAMPLE_SIZE = 64 * 1024
+# Largest keyframe timestamp which can be indexed, in milliseconds
+KEYFRAME_MAX = 2**32 - 1
+
+
+def get_fingerprint(st):
+    """
+    Build the fingerprint of a file: device, inode and size. It does not change when the file is
+    moved or renamed on the same file system.
+
+    :param os.stat_result st: status of the file
+    :return str: fingerprint
+    """
+    return "%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size)
+
+
+def get_content_hash(file_path, size):
+    """
+    Hash samples taken at the beginning, in the middle and at the end of a file. Unlike the
+    fingerprint, it does not change when the file is copied to another file system, while only a
+    few blocks are read.
+
+    :param str file_path: path of the file
+    :param int size: size of the file
+    :return str: size and hash of the samples, False if the file cannot be read
+    """
+    sha = hashlib.sha1()
+    offsets = {0, max(size // 2 - HASH_SAMPLE_SIZE // 2, 0), max(size - HASH_SAMPLE_SIZE, 0)}
+    try:
+        with open(file_path, "rb") as f:
+            for offset in sorted(offsets):
+                f.seek(offset)
+                sha.update(f.read(HASH_SAMPLE_SIZE))
+    except OSError:
+        return False
+    return "%d:%s" % (size, sha.hexdigest())
+
+
+def _init_probe_worker():
+    """
+    Initialize a probing process. The signal handlers of the server are inherited from the parent
+    process: the default ones are restored, so a stuck process can be terminated.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pymediainfo._after_fork()
+
+
+def _to_float(value):
+    """
+    Convert a raw MediaInfo value to a number. Some values are given for several sub-streams, e.g.
+    "1536000 / 768000": the first one is kept.
+    """
+    try:
+        return float((value or "0").split("/")[0])
+    except ValueError:
+        return 0.0
+
+
+def probe_media(file_path):
+    """
+    Get the infos of a media, thanks to MediaInfo. This function does not access the database, so
+    it can be executed in a separate process. The language of the audio tracks is None if unknown.
+    If the file cannot be read, the error is returned in the `error` key.
+
+    Only the necessary parameters are queried, which is much faster than parsing the complete
+    report of MediaInfo.
+
+    :param str file_path: path of the media to get the data from
+    :return dict: media data
+    """
+    vals = {"audio_tracks": 0, "audio_tracks_lang": [], "audio_codecs": []}
+    try:
+        media_info = MediaInfo.query(file_path, PROBE_PARAMETERS)
+        if not media_info["General"]:
+            raise RuntimeError("Unknown format")
+        for track in media_info["General"][:1]:
+            vals["duration"] = int(_to_float(track["Duration"]))
+            vals["container"] = track["Format"]
+        for track in media_info["Video"][:1]:
+            vals["video_codec"] = track["Format"]
+            vals["video_profile"] = track["Format_Profile"]
+            vals["height"] = int(_to_float(track["Height"]))
+            vals["width"] = int(_to_float(track["Width"]))
+            bitrate = _to_float(track["BitRate"]) or _to_float(track["BitRate_Nominal"])
+            vals["bitrate"] = int(bitrate / 1000.0)
+        for track in media_info["Audio"]:
+            vals["audio_tracks"] += 1
+            vals["audio_tracks_lang"] += [track["Language"]]
+            codec = track["Format"]
+            if codec == "MPEG Audio" and track["Format_Profile"] == "Layer 3":
+                codec = "MP3"
+            vals["audio_codecs"] += [codec]
+    except Exception as e:
+        _logger.warning('Error while opening file "%s"', file_path, exc_info=1)
+        vals["error"] = str(e) or e.__class__.__name__
+    return vals
+
+
+def get_keyframes(file_path, timeout=None):
+    """
+    Get the timestamps of the keyframes of the first video track, thanks to ffprobe. Only the
+    packet headers are read, the frames are not decoded.
+
+    :param str file_path: path of the media to get the keyframes from
+    :param int timeout: maximum number of seconds the indexing may take, None to wait forever
+    :return bytes: timestamps in milliseconds, packed as unsigned integers and base64 encoded
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=print_section=0",
+        file_path,
+    ]
+    keyframes = array("I")
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=timeout)
+        for line in output.decode("utf-8", "ignore").splitlines():
+            pts_time, flags = (line.split(",") + [""])[:2]
+            if "K" not in flags:
+                continue
+            try:
+                pts = int(float(pts_time) * 1000)
+            except (ValueError, OverflowError):
+                continue
+            # Streams starting with a negative timestamp are played from 0, and timestamps out of
+            # the range of the array cannot be seeked to anyway.
+            if pts <= KEYFRAME_MAX:
+                keyframes.append(max(pts, 0))
+    except (OSError, subprocess.SubprocessError):
+        _logger.warning('Error while indexing keyframes of "%s"', file_path, exc_info=1)
+        return False
+    return base64.b64encode(keyframes.tobytes())
+
+
 class VideoFolderScan(models.TransientModel):
     _name = "oovideo.folder.scan"
     _description = "Video Folder Scan"
@@ -36,46 +201,60 @@ class VideoFolderScan(models.TransientModel):
         self.env.cr.commit()
         return res
 
-    def _clean_directory(self, path, user_id):
+    def _clean_directory(self, path, user_id, folderlist, filelist):
         """
-        Clean a directory. It removes folders and media which are not on the disk anymore. This
-        can potentially deletes the folder linked to the given path if the path doesn't exist
-        anymore.
+        Clean a directory. It removes folders, media and errors of the files which are not on the
+        disk anymore. This can potentially deletes the folder linked to the given path if the path
+        doesn't exist anymore.
+
+        Only the records located in the directory are read, thanks to a prefix search supported
+        by an index on the path. The records are deleted by a single query per table, the children
+        records being removed by the database cascade. The listings of the folders which contained
+        the deleted records are invalidated.
 
         :param str path: path of the folder to clean
         :param int user_id: ID of the user to whom belongs the folder
+        :param set folderlist: paths of the existing directories, as found by `_walk_files`
+        :param set filelist: paths of the existing media files, as found by `_walk_files`
+        :return bool: True if records were deleted
         """
         _logger.debug('Cleaning folder "%s"...', path)
 
-        # List existing directories and files
-        filelist = set(" ")
-        folderlist = set(" ")
-        for rootdir, dirnames, filenames in os.walk(path):
-            folderlist.add(rootdir)
-            for fn in filenames:
-                fn_ext = fn.split(".")[-1]
-                if fn_ext and fn_ext.lower() in self.ALLOWED_FILE_EXTENSIONS:
-                    filelist.add(os.path.join(rootdir, fn))
-
-        track_data = [
-            (("id", "path"), "oovideo_folder", folderlist),
-            (("id", "path"), "oovideo_media", filelist),
-        ]
+        # Escape the LIKE wildcards which might be part of the path
+        prefix = path.rstrip(os.sep) + os.sep
+        prefix = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
 
         # Cleaning part:
-        # - select existing paths in table
+        # - select existing paths in table, under the directory
         # - compare with paths actually used
         # - deletes the ones which are not used anymore
-        for td in track_data:
-            field_list = ",".join([x for x in td[0]])
-            query = "SELECT " + field_list + " FROM " + td[1] + " WHERE user_id = " + str(user_id)
-            self.env.cr.execute(query)
-            res = self.env.cr.fetchall()
-            to_clean = {r[1] for r in res if path in r[1]} - td[2]
+        tables = [
+            ("oovideo_folder", folderlist, "parent_id"),
+            ("oovideo_media", filelist, "folder_id"),
+            ("oovideo_media_error", filelist, None),
+        ]
+        deleted = False
+        parent_ids = set()
+        for table, existing, parent_column in tables:
+            query = (
+                "SELECT id, path FROM " + table + " "
+                "WHERE user_id = %s AND (path = %s OR path LIKE %s)"
+            )
+            self.env.cr.execute(query, (user_id, path, prefix))
+            to_clean = [r[0] for r in self.env.cr.fetchall() if r[1] not in existing]
 
             if to_clean:
-                to_clean = {r[1]: r[0] for r in res if r[1] in to_clean}.values()
-                self.env[td[1].replace("_", ".")].browse(to_clean).sudo().unlink()
+                _logger.debug("Deleting %s records from %s", len(to_clean), table)
+                query = "DELETE FROM " + table + " WHERE id IN %s"
+                if parent_column:
+                    query += " RETURNING " + parent_column
+                self.env.cr.execute(query, (tuple(to_clean),))
+                if parent_column:
+                    parent_ids.update(r[0] for r in self.env.cr.fetchall() if r[0])
+                self.env[table.replace("_", ".")].invalidate_cache()
+                deleted = True
+        self.env["oovideo.folder"].browse(parent_ids)._bump_browse_generation()
+        return deleted
 
     def _build_cache(self, folder_id, user_id):
         """
@@ -99,16 +278,26 @@ class VideoFolderScan(models.TransientModel):
 
         params = (user_id, folder_id)
         query = """
-            SELECT path, id, last_modification FROM oovideo_media
+            SELECT path, id, last_modification, fingerprint, content_hash FROM oovideo_media
             WHERE user_id = %s AND root_folder_id = %s;
         """
         self.env.cr.execute(query, params)
         res = self.env.cr.fetchall()
-        cache["media"] = {r[0]: (r[1], r[2]) for r in res}
+        cache["media"] = {r[0]: (r[1], r[2], r[3], r[4]) for r in res}
+        cache["fingerprint"] = {r[3]: r[0] for r in res if r[3]}
+        cache["hash"] = {r[4]: r[0] for r in res if r[4]}
+
+        query = """
+            SELECT path, id, last_modification, fingerprint FROM oovideo_media_error
+            WHERE user_id = %s AND root_folder_id = %s;
+        """
+        self.env.cr.execute(query, params)
+        res = self.env.cr.fetchall()
+        cache["error"] = {r[0]: (r[1], r[2], r[3]) for r in res}
 
         return cache
 
-    def _manage_dir(self, rootdir, cache):
+    def _manage_dir(self, rootdir, mtime, cache):
         """
         For a given directory, checks that it is already in the cache.
         - If not in the cache, create the associated folder
@@ -116,16 +305,16 @@ class VideoFolderScan(models.TransientModel):
         If the last modification date is older than the one recorded, the folder is skipped
 
         :param str rootdir: folder to check
+        :param int mtime: last modification date of the folder
         :param dict cache: reading cache
         :return dict, bool: tuple with content of the cache updated, and boolean which indicates if
             the folder can be skipped
         """
         skip = False
         folder = cache["folder"].get(rootdir)
-        mtime = int(os.path.getmtime(rootdir))
 
         if not folder:
-            cache = self._create_folder(rootdir, cache)
+            cache = self._create_folder(rootdir, mtime, cache)
         elif folder[1] >= mtime:
             skip = True
         else:
@@ -135,18 +324,18 @@ class VideoFolderScan(models.TransientModel):
             Folder.write({"last_modification": mtime, "parent_id": parent_dir[0]})
         return cache, skip
 
-    def _create_folder(self, rootdir, cache):
+    def _create_folder(self, rootdir, mtime, cache):
         """
         Create the directory rootdir, and updates the cache.
 
         :param str rootdir: path of the folder to create
+        :param int mtime: last modification date of the folder
         :param dict cache: reading cache
         :return dict: cache updated
         """
         parent_dir = os.sep.join(rootdir.split(os.sep)[:-1])
         parent_dir = cache["folder"].get(parent_dir)
         if parent_dir:
-            mtime = int(os.path.getmtime(rootdir))
             vals = {
                 "root": False,
                 "path": rootdir,
@@ -166,42 +355,445 @@ class VideoFolderScan(models.TransientModel):
         :param str file_path: path of the media to get the data from
         :return dict: media data
         """
+        return self._format_media_info(probe_media(file_path))
+
+    def _format_media_info(self, media_info):
+        """
+        Complete the infos returned by `probe_media` with the data requiring the environment.
+
+        :param dict media_info: media data returned by `probe_media`
+        :return dict: media data
+        """
+        media_info["audio_tracks_lang"] = [
+            "{}: {}".format(i, lang or _("Unknown"))
+            for i, lang in enumerate(media_info.get("audio_tracks_lang", []), start=1)
+        ]
+        return media_info
+
+    def _probe_files(self, files, workers):
+        """
+        Probe files in a pool of processes. The files are consumed lazily, so that the walker can
+        feed the pool while the results are written. The results are returned in the same order as
+        the files.
+
+        Since the probing runs in separate processes, a file crashing MediaInfo does not affect the
+        server. If the probing of a file exceeds the timeout set by the system parameter
+        `oovideo.probe_timeout`, in seconds, an error is returned for this file with the `retry`
+        key set: the pool is terminated, and the files pending are probed again by a new pool. A
+        timeout may come from the process rather than from the file, e.g. a lock inherited from the
+        server when forking, so the file should be probed again at the next scan.
+
+        :param files: iterator of tuples, the path of the file being the first element
+        :param int workers: number of processes probing the files
+        :return: iterator of tuples (file tuple, media data)
+        """
+        workers = max(workers, 1)
+        timeout = max(
+            int(
+                self.env["ir.config_parameter"]
+                .sudo()
+                .get_param("oovideo.probe_timeout", PROBE_TIMEOUT)
+            ),
+            1,
+        )
+        # Fork, so the probing processes start quickly without importing the server again
+        context = multiprocessing.get_context("fork")
+        pool = context.Pool(workers, initializer=_init_probe_worker)
+        pending = deque()
         try:
-            media_info = MediaInfo.parse(file_path)
-            vals = {"audio_tracks": 0, "audio_tracks_lang": []}
-            for track in media_info.tracks:
-                if track.track_type == "General":
-                    vals["duration"] = int(float(track.duration or 0.0))
-                elif track.track_type == "Video":
-                    vals["height"] = track.height
-                    vals["width"] = track.width
-                    vals["bitrate"] = int(
-                        float(track.bit_rate or track.nominal_bit_rate or 0.0) / 1000.0
+            for f in itertools.chain(files, [None]):
+                if f is not None:
+                    pending.append((f, pool.apply_async(probe_media, (f[0],))))
+                # Limit the number of files waiting to be written, except at the end
+                while pending and (f is None or len(pending) >= workers * 4):
+                    f_done, result = pending.popleft()
+                    try:
+                        media_info = result.get(timeout)
+                    except multiprocessing.TimeoutError:
+                        _logger.warning('Timeout while probing file "%s"', f_done[0])
+                        media_info = {"error": "Timeout after %s seconds" % timeout, "retry": True}
+                        pool.terminate()
+                        pool = context.Pool(workers, initializer=_init_probe_worker)
+                        pending = deque(
+                            (p, pool.apply_async(probe_media, (p[0],))) for p, dummy in pending
+                        )
+                    except Exception as e:
+                        _logger.warning('Error while probing file "%s"', f_done[0], exc_info=1)
+                        media_info = {"error": str(e) or e.__class__.__name__}
+                    yield f_done, self._format_media_info(media_info)
+        finally:
+            pool.terminate()
+
+    def _flush_media(self, batch):
+        """
+        Write a batch of medias in the database, with a single INSERT for the new medias and a
+        single UPDATE for the existing ones. Like `_build_cache`, this avoids the ORM which does not
+        show the required performances for a large number of files. The ORM cache is invalidated
+        afterwards, as well as the listings of the folders where medias were added or moved.
+
+        All values of the batch must have the same keys. The batch is emptied.
+
+        :param dict batch: new medias values in `create`, tuples (ID, values) of the existing
+            medias in `write`
+        :return dict: IDs of the new medias, by path
+        """
+        VideoMedia = self.env["oovideo.media"]
+        res = {}
+        now = fields.Datetime.now()
+        log_vals = {"write_uid": self.env.uid, "write_date": now}
+        folder_ids = {vals["folder_id"] for vals in batch["create"]}
+
+        if batch["write"] and "path" in batch["write"][0][1]:
+            # The medias moved leave their former folder
+            self.env.cr.execute(
+                "SELECT id, folder_id, path FROM oovideo_media WHERE id IN %s",
+                (tuple(r[0] for r in batch["write"]),),
+            )
+            previous = {r[0]: r[1:] for r in self.env.cr.fetchall()}
+            for media_id, vals in batch["write"]:
+                folder_id, path = previous.get(media_id, (False, False))
+                if path != vals["path"]:
+                    folder_ids.update([folder_id, vals.get("folder_id", folder_id)])
+
+        if batch["create"]:
+            columns = list(batch["create"][0].keys()) + ["create_uid", "create_date"]
+            columns += list(log_vals.keys())
+            rows = []
+            for vals in batch["create"]:
+                vals = dict(vals, create_uid=self.env.uid, create_date=now, **log_vals)
+                rows.append(
+                    tuple(
+                        VideoMedia._fields[c].convert_to_column(vals[c], VideoMedia)
+                        for c in columns
                     )
-                elif track.track_type == "Audio":
-                    vals["audio_tracks"] += 1
-                    vals["audio_tracks_lang"] += [
-                        str(vals["audio_tracks"]) + ": " + (track.language or _("Unknown"))
-                    ]
-        except:
-            _logger.warning('Error while opening file "%s"', file_path, exc_info=1)
-        return vals
+                )
+            query = "INSERT INTO oovideo_media ({}) VALUES {} RETURNING id, path".format(
+                ", ".join('"{}"'.format(c) for c in columns), ", ".join(["%s"] * len(rows))
+            )
+            self.env.cr.execute(query, rows)
+            res = {r[1]: r[0] for r in self.env.cr.fetchall()}
+
+        if batch["write"]:
+            columns = list(batch["write"][0][1].keys()) + list(log_vals.keys())
+            rows = []
+            for media_id, vals in batch["write"]:
+                vals = dict(vals, **log_vals)
+                rows.append(
+                    (media_id,)
+                    + tuple(
+                        VideoMedia._fields[c].convert_to_column(vals[c], VideoMedia)
+                        for c in columns
+                    )
+                )
+            # The values are cast explicitly, since their type cannot be inferred from VALUES
+            query = """
+                UPDATE oovideo_media AS m SET {}
+                FROM (VALUES {}) AS v(id, {})
+                WHERE m.id = v.id
+            """.format(
+                ", ".join(
+                    '"{0}" = v."{0}"::{1}'.format(c, VideoMedia._fields[c].column_type[1])
+                    for c in columns
+                ),
+                ", ".join(["%s"] * len(rows)),
+                ", ".join('"{}"'.format(c) for c in columns),
+            )
+            self.env.cr.execute(query, rows)
+
+        batch["create"] = []
+        batch["write"] = []
+        VideoMedia.invalidate_cache()
+        self.env["oovideo.folder"].browse([f for f in folder_ids if f])._bump_browse_generation()
+        return res
+
+    def _index_keyframes(self, media_ids, workers):
+        """
+        Index the keyframes of medias, in a separate pass once they are written. The indexing reads
+        the whole file, so it is not bound by the probe timeout: ffprobe has its own timeout, set
+        by the system parameter `oovideo.keyframe_timeout`, in seconds. A media which could not be
+        indexed keeps an empty index, and its segments are cut on a fixed grid.
+
+        :param list media_ids: IDs of the medias to index
+        :param int workers: number of ffprobe processes running at the same time
+        """
+        if not media_ids:
+            return
+        VideoMedia = self.env["oovideo.media"]
+        ICP = self.env["ir.config_parameter"].sudo()
+        timeout = max(int(ICP.get_param("oovideo.keyframe_timeout", KEYFRAME_TIMEOUT)), 1)
+        batch_size = max(int(ICP.get_param("oovideo.scan_batch_size", 100)), 1)
+        self.env.cr.execute(
+            "SELECT id, path FROM oovideo_media WHERE id IN %s", (tuple(media_ids),)
+        )
+        medias = self.env.cr.fetchall()
+
+        # The work is done by the ffprobe processes, the threads only wait for them
+        with ThreadPoolExecutor(max(workers, 1)) as executor:
+            results = executor.map(lambda m: (m[0], get_keyframes(m[1], timeout)), medias)
+            for i, (media_id, keyframes) in enumerate(results, start=1):
+                self.env.cr.execute(
+                    "UPDATE oovideo_media SET keyframes = %s WHERE id = %s",
+                    (
+                        VideoMedia._fields["keyframes"].convert_to_column(keyframes, VideoMedia),
+                        media_id,
+                    ),
+                )
+                if not i % batch_size and not self.env.context.get("test_mode"):
+                    self.env.cr.commit()
+        VideoMedia.invalidate_cache()
+
+    def _index_subtitles(self, subtitles, cache):
+        """
+        Index the subtitle files of the listed directories. A subtitle file belongs to the media
+        whose name (without extension) starts the name of the subtitle file, e.g. "Movie.en.srt"
+        for "Movie.mkv". The subtitles previously indexed in these directories are replaced.
+
+        :param dict subtitles: names of the subtitle files, by directory
+        :param dict cache: reading cache
+        """
+        VideoSubtitle = self.env["oovideo.subtitle"]
+        folder_ids = [cache["folder"][d][0] for d in subtitles if d in cache["folder"]]
+        if not folder_ids:
+            return
+        self.env.cr.execute(
+            "SELECT id, name, path FROM oovideo_media WHERE folder_id IN %s", (tuple(folder_ids),)
+        )
+        media_by_dir = {}
+        for media_id, name, path in self.env.cr.fetchall():
+            media_by_dir.setdefault(os.path.dirname(path), []).append((media_id, name))
+
+        self.env.cr.execute(
+            "DELETE FROM oovideo_subtitle WHERE media_id IN "
+            "(SELECT id FROM oovideo_media WHERE folder_id IN %s)",
+            (tuple(folder_ids),),
+        )
+        vals_list = []
+        for rootdir, file_names in subtitles.items():
+            for file_name in file_names:
+                # The longest name wins, e.g. "Movie 2.srt" belongs to "Movie 2.mkv", not "Movie.mkv"
+                matches = [
+                    (len(os.path.splitext(name)[0]), media_id, name)
+                    for media_id, name in media_by_dir.get(rootdir, [])
+                    if file_name.startswith(os.path.splitext(name)[0])
+                ]
+                if not matches:
+                    continue
+                dummy, media_id, media_name = max(matches)
+                vals_list.append(
+                    {
+                        "name": file_name,
+                        "path": os.path.join(rootdir, file_name),
+                        "lang": guess_language(file_name, media_name),
+                        "media_id": media_id,
+                        "user_id": cache["user_id"],
+                    }
+                )
+        VideoSubtitle.invalidate_cache()
+        if vals_list:
+            VideoSubtitle.sudo().create(vals_list)
+
+    def _record_errors(self, errors, fixed_error_ids, cache, folder_id):
+        """
+        Record the files which could not be read, with their modification date and fingerprint.
+        They are not probed again until they are modified.
 
-    def _scan_folder(self, folder_id):
+        :param list errors: tuples (file tuple, error message) of the files which could not be read
+        :param list fixed_error_ids: IDs of the errors of the files which were read successfully
+        :param dict cache: reading cache
+        :param int folder_id: ID of the scanned folder
+        """
+        MediaError = self.env["oovideo.media.error"].sudo()
+        if fixed_error_ids:
+            MediaError.browse(fixed_error_ids).unlink()
+        vals_list = []
+        for (fn_path, fn, mtime, rootdir, fingerprint, content_hash), error in errors:
+            vals = {
+                "name": fn,
+                "path": fn_path,
+                "error": error,
+                "last_modification": mtime,
+                "fingerprint": fingerprint,
+            }
+            if fn_path in cache["error"]:
+                MediaError.browse(cache["error"][fn_path][0]).write(vals)
+            else:
+                vals.update({"root_folder_id": folder_id, "user_id": cache["user_id"]})
+                vals_list.append(vals)
+        if vals_list:
+            MediaError.create(vals_list)
+
+    def _find_moved_media(self, fingerprint, content_hash, cache):
+        """
+        Find the media which was moved to a new path, thanks to its fingerprint or content hash.
+        The media must not exist anymore at its recorded path, so a copy is not mistaken for a
+        move.
+
+        :param str fingerprint: fingerprint of the new file
+        :param str content_hash: content hash of the new file, False if not computed
+        :param dict cache: reading cache
+        :return str: recorded path of the moved media, None if not found
+        """
+        for key, value in (("fingerprint", fingerprint), ("hash", content_hash)):
+            old_path = cache[key].get(value) if value else None
+            if old_path and old_path in cache["media"] and not os.path.lexists(old_path):
+                return old_path
+        return None
+
+    def _walk_files(self, path, cache, seen):
+        """
+        Walk in all sub-directories of a folder, and return the files which need to be scanned.
+        The folders are created or updated along the way.
+
+        The walk relies on `os.scandir`, so each entry is stat'ed at most once. A directory which
+        was not modified since the last scan is not listed again: its entries did not change, so
+        the media and sub-directories recorded in the cache are used instead. Only the
+        sub-directories are stat'ed to detect the changes deeper in the tree.
+
+        The existing directories and media files are added to `seen`, which allows cleaning the
+        database afterwards without walking a second time. The subtitle files found in the listed
+        directories are added as well, so they can be indexed once the media are written.
+
+        A new file whose fingerprint matches a media which disappeared is a moved media: the media
+        keeps its ID, and is not probed again unless modified. The new path of the moved media, and
+        the fingerprints which changed, are added to `seen` as well. The files which could not be
+        read are skipped, unless modified since. They are added to the existing media files of
+        `seen`, so their errors are kept by the clean-up.
+
+        :param str path: path of the folder to walk in
+        :param dict cache: reading cache
+        :param dict seen: sets of the paths of the existing directories in `folder`, and of the
+            existing media files in `media`; names of the subtitle files by listed directory in
+            `subtitle`; tuples (ID, values) of the unmodified media to update in `update`
+        :return: iterator of tuples (file path, file name, modification date, directory,
+            fingerprint, content hash)
+        """
+        children = {}
+        for folder_path in cache["folder"]:
+            children.setdefault(os.path.dirname(folder_path), []).append(folder_path)
+        # Files known in each directory, including the unreadable ones, so the errors of an
+        # unchanged directory are not cleaned
+        media_by_dir = {}
+        for media_path in itertools.chain(cache["media"], cache["error"]):
+            media_by_dir.setdefault(os.path.dirname(media_path), []).append(media_path)
+
+        try:
+            stack = [(path, int(os.stat(path).st_mtime))]
+        except OSError:
+            return
+        while stack:
+            rootdir, mtime = stack.pop()
+            seen["folder"].add(rootdir)
+
+            cache, skip = self._manage_dir(rootdir, mtime, cache)
+            if skip:
+                _logger.debug('Skipping unchanged folder "%s"...', rootdir)
+                seen["media"].update(media_by_dir.get(rootdir, []))
+                for sub_dir in children.get(rootdir, []):
+                    try:
+                        sub_stat = os.stat(sub_dir)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(sub_stat.st_mode):
+                        stack.append((sub_dir, int(sub_stat.st_mtime)))
+                continue
+
+            _logger.debug('Scanning folder "%s"...', rootdir)
+            try:
+                entries = sorted(os.scandir(rootdir), key=lambda e: e.name)
+            except OSError:
+                continue
+            sub_dirs = []
+            subtitles = seen["subtitle"].setdefault(rootdir, [])
+            for entry in entries:
+                try:
+                    # Like os.walk, do not follow the symbolic links to directories
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            sub_dirs.append((entry.path, int(entry.stat().st_mtime)))
+                        continue
+
+                    # Check file extension
+                    fn_ext = entry.name.split(".")[-1]
+                    if fn_ext and fn_ext.lower() in SUBTITLE_EXTENSIONS:
+                        subtitles.append(entry.name)
+                        continue
+                    if fn_ext and fn_ext.lower() not in self.ALLOWED_FILE_EXTENSIONS:
+                        continue
+
+                    fn_path = entry.path
+                    fn_stat = entry.stat()
+                    fn_mtime = int(fn_stat.st_mtime)
+                except OSError:
+                    continue
+                seen["media"].add(fn_path)
+
+                media = cache["media"].get(fn_path)
+                unmodified = media and media[1] >= fn_mtime
+                fingerprint = get_fingerprint(fn_stat)
+                content_hash = media[3] if unmodified else False
+                if cache["hash_files"] and not content_hash:
+                    content_hash = get_content_hash(fn_path, fn_stat.st_size)
+
+                # Reconcile a new path with a media which disappeared, before it is deleted
+                moved = False
+                if not media:
+                    old_path = self._find_moved_media(fingerprint, content_hash, cache)
+                    if old_path:
+                        _logger.debug('Media "%s" moved to "%s"', old_path, fn_path)
+                        media = cache["media"][fn_path] = cache["media"].pop(old_path)
+                        unmodified = media[1] >= fn_mtime
+                        content_hash = content_hash or (media[3] if unmodified else False)
+                        moved = True
+
+                # Skip file if already in DB
+                if unmodified:
+                    if moved or (media[2], media[3]) != (fingerprint, content_hash):
+                        vals = {
+                            "name": entry.name,
+                            "path": fn_path,
+                            "folder_id": cache["folder"][rootdir][0],
+                            "fingerprint": fingerprint,
+                            "content_hash": content_hash,
+                        }
+                        seen["update"].append((media[0], vals))
+                    continue
+
+                # Skip file if it could not be read, until it is modified
+                error = cache["error"].get(fn_path)
+                if error and error[1:] == (fn_mtime, fingerprint):
+                    continue
+
+                yield fn_path, entry.name, fn_mtime, rootdir, fingerprint, content_hash
+
+            # Reversed, so the sub-directories are walked in alphabetical order
+            stack.extend(reversed(sub_dirs))
+
+    def _scan_folder(self, folder_id, subpaths=None):
         """
         The folder scanning method. It walks in all sub-directories of the folder. If the
-        modification date is more recent than the recorded date, the directory is scanned.
+        modification date is more recent than the recorded date, the directory is scanned. The
+        folders and media which are not on the disk anymore are removed at the end of the walk.
+        The media moved or renamed are recognized thanks to their fingerprint, and only their path
+        is updated.
 
         A file is scanned if these conditions are met:
         - the extension matches the allowed file extensions;
         - the last modification date is more recent than the recorded date, in order to update data
-          of an existing record.
+          of an existing record;
+        - the file could be read at the last scan, or was modified since.
         During the scan, any new album or artists will be created as well.
 
-        There is an arbitrary commit every 100 medias, which should allow a regular update of the
-        database.
+        The files are probed in parallel by the number of processes set on the folder, while the
+        results are written by the scanning thread. The medias are written by batches, followed by
+        a commit, which should allow a regular update of the database. A file whose probing timed
+        out is neither written nor recorded as an error: its directory is scanned again at the next
+        scan. If enabled on the folder, the keyframes of the medias written are indexed afterwards.
+
+        A targeted scan can be executed on some sub-directories only, e.g. the ones where changes
+        were detected. Only these sub-directories are walked and cleaned.
 
         :param int folder_id: ID of the folder to scan
+        :param list subpaths: paths of the sub-directories to scan, the whole folder if not set
         """
         with api.Environment.manage(), self.pool.cursor() as cr:
             time_start = dt.now()
@@ -216,80 +808,124 @@ class VideoFolderScan(models.TransientModel):
                     return {}
 
             VideoFolder = self.env["oovideo.folder"]
-            VideoMedia = self.env["oovideo.media"]
 
             folder = VideoFolder.browse([folder_id])
 
-            # Clean-up the DB before actual scan
-            self._clean_directory(folder.path, folder.user_id.id)
-            if not folder.exists():
-                if not self.env.context.get("test_mode"):
-                    self.env.cr.commit()
-                return {}
-
             # Build the cache
             # - cache is used for read/search, i.e. avoid reading/searching same info several times
             # - cache_write is used for writing tracks info on other models and avoid stored
             #   related/computed fields
             cache = self._build_cache(folder.id, folder.user_id.id)
-            i = len(cache["media"].keys())
-
-            # Start scanning
-            for rootdir, dirnames, filenames in os.walk(folder.path):
-                _logger.debug('Scanning folder "%s"...', rootdir)
-
-                cache, skip = self._manage_dir(rootdir, cache)
-                if skip:
+            cache["hash_files"] = folder.hash_files
+            folder_count = len(cache["folder"])
+            batch = {"create": [], "write": []}
+            batch_size = max(
+                int(
+                    self.env["ir.config_parameter"].sudo().get_param("oovideo.scan_batch_size", 100)
+                ),
+                1,
+            )
+
+            # Start scanning. The walker feeds the probing pool, while the results are written
+            # in this thread.
+            seen = {"folder": set(), "media": set(), "subtitle": {}, "update": []}
+            media_ids = []
+            errors = []
+            fixed_error_ids = []
+            retry_dirs = set()
+            paths = subpaths or [folder.path]
+            files = itertools.chain.from_iterable(
+                self._walk_files(path, cache, seen) for path in paths
+            )
+            for f, media_info in self._probe_files(files, folder.scan_workers):
+                fn_path, fn, mtime, rootdir, fingerprint, content_hash = f
+                if media_info.get("retry"):
+                    retry_dirs.add(rootdir)
+                    continue
+                if media_info.get("error"):
+                    errors.append((f, media_info["error"]))
                     continue
+                if fn_path in cache["error"]:
+                    fixed_error_ids.append(cache["error"][fn_path][0])
+
+                # Aggregate info
+                vals = {
+                    "name": fn,
+                    "duration": media_info.get("duration", 0),
+                    "height": media_info.get("height", 0),
+                    "width": media_info.get("width", 0),
+                    "bitrate": media_info.get("bitrate", 1000),
+                    "audio_tracks": media_info.get("audio_tracks", 0),
+                    "audio_tracks_lang": str(media_info.get("audio_tracks_lang", [])),
+                    "audio_codecs": str(media_info.get("audio_codecs", [])),
+                    "container": media_info.get("container") or False,
+                    "video_codec": media_info.get("video_codec") or False,
+                    "video_profile": media_info.get("video_profile") or False,
+                    "path": fn_path,
+                    "last_modification": mtime,
+                    "fingerprint": fingerprint,
+                    "content_hash": content_hash,
+                    "root_folder_id": folder_id,
+                    "folder_id": cache["folder"][rootdir][0],
+                    "user_id": cache["user_id"],
+                    # An index built before the file was modified is outdated. If enabled, the
+                    # keyframes are indexed once the medias are written.
+                    "keyframes": False,
+                }
+
+                # Create the track. No need to insert a new track in the cache, since we won't
+                # scan it during the process.
+                if fn_path in cache["media"].keys():
+                    batch["write"].append((cache["media"][fn_path][0], vals))
+                else:
+                    batch["create"].append(vals)
+
+                # Flush and commit every batch of tracks
+                if len(batch["create"]) + len(batch["write"]) >= batch_size:
+                    media_ids += [r[0] for r in batch["write"]]
+                    media_ids += self._flush_media(batch).values()
+                    # Commit and close the transaction
+                    if not self.env.context.get("test_mode"):
+                        self.env.cr.commit()
+            media_ids += [r[0] for r in batch["write"]]
+            media_ids += self._flush_media(batch).values()
+
+            # Move the media to their new path before cleaning, so they keep their ID
+            for i in range(0, len(seen["update"]), batch_size):
+                self._flush_media({"create": [], "write": seen["update"][i : i + batch_size]})
+            self._index_subtitles(seen["subtitle"], cache)
+            self._record_errors(errors, fixed_error_ids, cache, folder_id)
+            if retry_dirs:
+                self.env.cr.execute(
+                    "UPDATE oovideo_folder SET last_modification = 0 WHERE id IN %s",
+                    (tuple(cache["folder"][d][0] for d in retry_dirs),),
+                )
+                self.env["oovideo.folder"].invalidate_cache()
 
-                for fn in filenames:
-                    # Check file extension
-                    fn_ext = fn.split(".")[-1]
-                    if fn_ext and fn_ext.lower() not in self.ALLOWED_FILE_EXTENSIONS:
-                        continue
+            # Clean-up the DB thanks to the paths found during the scan
+            changed = bool(media_ids or seen["update"] or len(cache["folder"]) != folder_count)
+            for path in paths:
+                if self._clean_directory(path, folder.user_id.id, seen["folder"], seen["media"]):
+                    changed = True
 
-                    # Skip file if already in DB
-                    fn_path = os.path.join(rootdir, fn)
-                    mtime = int(os.path.getmtime(fn_path))
-                    if fn_path in cache["media"].keys() and cache["media"][fn_path][1] >= mtime:
-                        continue
+            # Index the keyframes once the media are committed, since the whole files are read
+            if media_ids and folder.exists() and folder.index_keyframes:
+                if not self.env.context.get("test_mode"):
+                    self.env.cr.commit()
+                self._index_keyframes(media_ids, folder.scan_workers)
 
-                    # Get media info
-                    media_info = self._get_media_info(os.path.join(rootdir, fn))
-
-                    # Aggregate info
-                    vals = {
-                        "name": fn,
-                        "duration": media_info.get("duration", 0),
-                        "height": media_info.get("height", 0),
-                        "width": media_info.get("width", 0),
-                        "bitrate": media_info.get("bitrate", 1000),
-                        "audio_tracks": media_info.get("audio_tracks", 0),
-                        "audio_tracks_lang": str(media_info.get("audio_tracks_lang", [])),
-                        "path": fn_path,
-                        "last_modification": mtime,
-                        "root_folder_id": folder_id,
-                        "folder_id": cache["folder"][rootdir][0],
-                        "user_id": cache["user_id"],
-                    }
+            # Generate the previews of the new and modified media in the background
+            if media_ids and folder.exists() and folder.generate_previews:
+                self.env["oovideo.media"].browse(media_ids).exists()._queue_previews()
 
-                    # Create the track. No need to insert a new track in the cache, since we won't
-                    # scan it during the process.
-                    if fn_path in cache["media"].keys():
-                        media = VideoMedia.browse(cache["media"][fn_path][0])
-                        media.write(vals)
-                    else:
-                        media = VideoMedia.create(vals)
-
-                    # Commit every 1000 tracks
-                    i = i + 1
-                    if i % 100 == 0:
-                        # Commit and close the transaction
-                        if not self.env.context.get("test_mode"):
-                            self.env.cr.commit()
+            # Refresh the preview from the media found
+            if folder.exists() and (changed or not folder.root_preview):
+                folder._refresh_root_preview()
 
             # Final stuff to write and tags cleaning
-            if folder.exists():
+            if folder.exists() and subpaths:
+                folder.write({"locked": False})
+            elif folder.exists():
                 folder.write(
                     {
                         "last_scan": fields.Datetime.now(),
@@ -1,12 +1,37 @@
 # -*- coding: utf-8 -*-
 
 import ast
-import glob
+import base64
+import math
 import os
+import uuid
+from array import array
 from io import BytesIO
 
+from werkzeug.urls import url_quote
+
 from odoo import fields, models, _
-from .oovideo_transcoder import BR_LIST, RES_LIST
+from odoo.tools.sql import column_exists, create_index, table_exists
+from .oovideo_cache import get_cache_dir
+from .oovideo_preview import PreviewJob, get_preview_paths, preview_queue
+from .oovideo_transcoder import AUDIO_BITRATE, BR_LIST, RES_BITRATE, RES_LIST, SEGMENT_DURATION
+
+# Codecs which can be copied as is in a HLS stream
+REMUX_AUDIO_CODECS = {"AAC", "MP3"}
+# H.264 profiles not supported by most browsers
+REMUX_EXCLUDED_PROFILES = ("High 10", "High 4:2:2", "High 4:4:4")
+# Capabilities declared by the browser, by codec name as given by MediaInfo
+CODEC_CAPABILITIES = {
+    "AVC": "h264",
+    "HEVC": "hevc",
+    "VP8": "vp8",
+    "VP9": "vp9",
+    "AV1": "av1",
+    "AAC": "aac",
+    "MP3": "mp3",
+    "Opus": "opus",
+    "Vorbis": "vorbis",
+}
 
 
 class VideoMedia(models.Model):
@@ -21,13 +46,31 @@ class VideoMedia(models.Model):
     bitrate = fields.Integer("Bitrate")
     audio_tracks = fields.Integer("# Audio Tracks")
     audio_tracks_lang = fields.Char("Audio Tracks Languages")
+    audio_codecs = fields.Char("Audio Tracks Codecs")
+    container = fields.Char("Container")
+    video_codec = fields.Char("Video Codec")
+    video_profile = fields.Char("Video Profile")
     path = fields.Char("Path", required=True, index=True)
+    subtitle_ids = fields.One2many("oovideo.subtitle", "media_id", string="Subtitles")
+    keyframes = fields.Binary(
+        "Keyframes",
+        attachment=False,
+        help="Timestamps of the keyframes in milliseconds, packed as unsigned integers",
+    )
+    fingerprint = fields.Char(
+        "Fingerprint",
+        index=True,
+        help="Device, inode and size of the file, used to detect the moved files while scanning",
+    )
+    content_hash = fields.Char(
+        "Content Hash", help="Hash of samples of the file, used to detect the moved files"
+    )
     last_modification = fields.Integer("Last Modification")
     root_folder_id = fields.Many2one(
         "oovideo.folder", string="Root Folder", required=True, ondelete="cascade"
     )
     folder_id = fields.Many2one(
-        "oovideo.folder", string="Folder", required=True, ondelete="cascade"
+        "oovideo.folder", string="Folder", required=True, index=True, ondelete="cascade"
     )
 
     user_id = fields.Many2one(
@@ -39,19 +82,38 @@ class VideoMedia(models.Model):
         default=lambda self: self.env.user,
     )
 
+    def _auto_init(self):
+        new_column = not column_exists(self.env.cr, self._table, "fingerprint")
+        res = super(VideoMedia, self)._auto_init()
+        if new_column and table_exists(self.env.cr, "oovideo_folder"):
+            # The directories must be listed again to record the fingerprints of the media
+            self.env.cr.execute("UPDATE oovideo_folder SET last_modification = 0")
+        return res
+
+    def init(self):
+        # Support the prefix searches on the path, used to clean a directory
+        create_index(
+            self.env.cr,
+            "oovideo_media_user_id_path_index",
+            self._table,
+            ["user_id", "path text_pattern_ops"],
+        )
+
+    def unlink(self):
+        self.mapped("folder_id")._bump_browse_generation()
+        return super(VideoMedia, self).unlink()
+
     def oovideo_media_info(self):
         self.ensure_one()
         res_list = [_("Original")]
+        if self._get_renditions():
+            res_list += ["auto"]
         res_list += [
             k
             for k, v in RES_LIST.items()
             if int(v.split("x")[0]) <= self.width or int(v.split("x")[1]) <= self.height
         ]
         br_list = [self.bitrate] + [b for b in BR_LIST if b <= self.bitrate]
-        os.chdir(self.folder_id.path)
-        sub_files = []
-        for sub_type in ("*.srt", "*.vtt", "*.sbv"):
-            sub_files.extend(glob.glob(glob.escape(os.path.splitext(self.path)[0]) + sub_type))
 
         return {
             "name": self.name,
@@ -60,19 +122,261 @@ class VideoMedia(models.Model):
             "audio_tracks_lang": ast.literal_eval(self.audio_tracks_lang),
             "br_list": br_list,
             "res_list": res_list,
+            "preview": "/oovideo/preview/{}.vtt".format(self.id) if self._get_preview() else False,
             "sub_list": [
                 {
-                    "srclang": "en",
+                    "srclang": sub.lang or "und",
                     "kind": "subtitles",
-                    "label": os.path.basename(f),
-                    "src": "/oovideo/sub/{}?sub={}".format(self.id, os.path.basename(f)),
+                    "label": sub.name,
+                    "src": "/oovideo/sub/{}?sub={}".format(self.id, url_quote(sub.name)),
                 }
-                for f in sub_files
+                for sub in self.subtitle_ids
             ],
         }
 
+    def _get_segments(self, keyframe_aligned=True):
+        """
+        Split the media in segments. If the keyframes of the media are indexed, the segment
+        boundaries are placed on the keyframes which are the closest to the segment duration.
+        Otherwise, the media is split every `SEGMENT_DURATION` seconds.
+
+        :param bool keyframe_aligned: align the segments on the keyframes, if indexed
+        :return list: tuples (start, duration) of the segments, in seconds
+        """
+        self.ensure_one()
+        total_duration = self.duration // 1000
+        if not keyframe_aligned or not self.keyframes:
+            return [
+                (seek, min(SEGMENT_DURATION, total_duration - seek))
+                for seek in range(0, total_duration, SEGMENT_DURATION)
+            ]
+
+        keyframes = array("I")
+        keyframes.frombytes(base64.b64decode(self.keyframes))
+        bounds = [0.0]
+        prev = 0.0
+        for t in (k / 1000.0 for k in keyframes):
+            if t >= total_duration:
+                break
+            while t >= bounds[-1] + SEGMENT_DURATION:
+                target = bounds[-1] + SEGMENT_DURATION
+                if prev - bounds[-1] >= SEGMENT_DURATION / 2 and target - prev < t - target:
+                    bounds.append(prev)
+                else:
+                    bounds.append(t)
+            prev = t
+        bounds.append(float(total_duration))
+        return [
+            (round(start, 3), round(end - start, 3))
+            for start, end in zip(bounds, bounds[1:])
+            if end > start
+        ]
+
+    def _can_remux(self, bitrate, resolution):
+        """
+        Check if the media can be streamed by copying its tracks in the output container, instead
+        of transcoding them. The video must be H.264 in a profile supported by the browsers, all
+        audio tracks AAC or MP3, and the requested resolution and bitrate must not require a new
+        encoding. Since a copied stream can only be cut on keyframes, the keyframes must be
+        indexed so the segments are aligned on them.
+
+        :param str bitrate: requested bitrate, in kbps
+        :param str resolution: requested resolution, e.g. "1280x720"
+        :return bool: True if the media can be remuxed
+        """
+        self.ensure_one()
+        if self.video_codec != "AVC" or not self.keyframes:
+            return False
+        if (self.video_profile or "").startswith(REMUX_EXCLUDED_PROFILES):
+            return False
+        audio_codecs = ast.literal_eval(self.audio_codecs or "[]")
+        if not audio_codecs or not set(audio_codecs) <= REMUX_AUDIO_CODECS:
+            return False
+        if resolution != "%sx%s" % (self.width, self.height):
+            return False
+        try:
+            return int(bitrate) >= self.bitrate
+        except ValueError:
+            return False
+
+    def _get_preview_dir(self):
+        self.ensure_one()
+        return get_cache_dir(self.env.cr.dbname, os.path.join("previews", str(self.id)))
+
+    def _get_preview(self):
+        """
+        Return the paths of the thumbnail sprite and of the WebVTT track used to preview the
+        media while seeking, if they were generated for the current version of the media.
+
+        :return tuple: paths of the sprite and of the track, or None if not generated
+        """
+        self.ensure_one()
+        sprite, track = get_preview_paths(self._get_preview_dir(), self.last_modification)
+        return (sprite, track) if os.path.isfile(track) else None
+
+    def _queue_previews(self):
+        """
+        Generate the previews of the media in the background.
+        """
+        jobs = []
+        for media in self:
+            if media._get_preview():
+                continue
+            jobs.append(
+                PreviewJob(
+                    media.path,
+                    media.duration // 1000,
+                    media.width,
+                    media.height,
+                    media._get_preview_dir(),
+                    media.last_modification,
+                    "{}.jpg".format(media.id),
+                )
+            )
+        if jobs:
+            preview_queue.submit(jobs)
+
+    def _get_format(self):
+        """
+        Return the format of the media file, based on its extension.
+
+        :return: oovideo.format record, empty if the format is unknown
+        """
+        self.ensure_one()
+        ext = os.path.splitext(self.path)[1][1:].lower()
+        return self.env["oovideo.format"].search([("name", "=", ext)], limit=1)
+
+    def _can_direct_play(self, capabilities, bitrate=None, resolution=None, lang=None):
+        """
+        Check if the media file can be sent as is to the browser. The container must be flagged
+        as supported by the browser, and the browser must declare the support of the container
+        and of all codecs. Since the file is sent as is, the requested resolution, bitrate and
+        audio track must be the original ones.
+
+        :param list capabilities: containers and codecs supported by the browser
+        :param str bitrate: requested bitrate, None for the original
+        :param str resolution: requested resolution, None for the original
+        :param str lang: requested audio track, None for the default one
+        :return bool: True if the media can be played directly
+        """
+        self.ensure_one()
+        media_format = self._get_format()
+        if not media_format.browser_support or media_format.name not in capabilities:
+            return False
+        codecs = [self.video_codec] + ast.literal_eval(self.audio_codecs or "[]")
+        if not all(CODEC_CAPABILITIES.get(c) in capabilities for c in codecs):
+            return False
+        if resolution not in (None, "orig", "%sx%s" % (self.width, self.height)):
+            return False
+        if bitrate is not None and str(bitrate) != str(self.bitrate):
+            return False
+        return lang in (None, "1") or self.audio_tracks <= 1
+
+    def oovideo_playback(self, capabilities, **kwargs):
+        """
+        Choose the cheapest way to play the media in the browser:
+        - direct play: the file is sent as is;
+        - remux: the tracks are copied in a HLS stream;
+        - transcode: the tracks are encoded in a HLS stream.
+
+        The resolution, bitrate and language are optional. If not given, the original media is
+        played if possible, otherwise the adaptive-bitrate playlist is used.
+
+        :param list capabilities: containers and codecs supported by the browser, as declared by
+            the player, e.g. ["mp4", "webm", "h264", "aac"]
+        :return dict: playback mode, URL and mimetype of the source
+        """
+        self.ensure_one()
+        bitrate = kwargs.get("br")
+        resolution = kwargs.get("res")
+        lang = kwargs.get("lang")
+        if self._can_direct_play(capabilities, bitrate, resolution, lang):
+            media_format = self._get_format()
+            return {
+                "mode": "direct",
+                "url": "/oovideo/stream/{}.{}".format(self.id, media_format.name),
+                "mimetype": media_format.mimetype,
+            }
+
+        transcoder = self.env.ref("oovideo.oovideo_transcoder_0")
+        remux_support = bool(
+            transcoder.remux_command and not transcoder.session_mode and "h264" in capabilities
+        )
+        original = "%sx%s" % (self.width, self.height)
+        if resolution is None and bitrate is None:
+            if remux_support and self._can_remux(str(self.bitrate), original):
+                resolution = "orig"
+            elif self._get_renditions():
+                resolution = "auto"
+        resolution = resolution or "orig"
+        bitrate = bitrate or self.bitrate
+        remux = (
+            remux_support
+            and resolution != "auto"
+            and self._can_remux(str(bitrate), RES_LIST.get(resolution, original))
+        )
+        return {
+            "mode": "remux" if remux else "transcode",
+            "url": "/oovideo/stream/{}.m3u8?br={}&res={}&lang={}".format(
+                self.id, bitrate, resolution, lang or "1"
+            ),
+            "mimetype": "application/x-mpegurl",
+        }
+
+    def _get_renditions(self):
+        """
+        Build the ladder of renditions advertised in the adaptive-bitrate master playlist. Only
+        the resolutions which do not exceed the one of the source are kept, and the bitrate of a
+        rendition never exceeds the one of the source.
+
+        :return list: tuples (resolution, dimensions, bitrate) of the renditions, from the lowest
+            to the highest quality
+        """
+        self.ensure_one()
+        res = []
+        for name, dimensions in RES_LIST.items():
+            width, height = (int(x) for x in dimensions.split("x"))
+            if width > self.width or height > self.height:
+                continue
+            bitrate = RES_BITRATE[name]
+            if self.bitrate:
+                bitrate = min(bitrate, self.bitrate)
+            if res and bitrate <= res[-1][2]:
+                # Same bitrate as the previous rendition: no point in offering both
+                continue
+            res.append((name, dimensions, bitrate))
+        return res
+
+    def _oovideo_master_playlist(self, **kwargs):
+        """
+        Build the adaptive-bitrate master playlist. Each rendition points to the media playlist
+        of the corresponding resolution and bitrate. Since the segments are split on the same
+        boundaries for every rendition, the player can switch between them at any segment.
+
+        :return BytesIO: master playlist
+        """
+        self.ensure_one()
+        lang = kwargs.get("lang", 1)
+        res_str = ""
+        res_str += "#EXTM3U\n"
+        res_str += "#EXT-X-VERSION:3\n"
+        for name, dimensions, bitrate in self._get_renditions():
+            res_str += "#EXT-X-STREAM-INF:BANDWIDTH=%s,RESOLUTION=%s\n" % (
+                (bitrate + AUDIO_BITRATE) * 1000,
+                dimensions,
+            )
+            res_str += "/oovideo/stream/{}.m3u8?br={}&res={}&lang={}\n".format(
+                self.id, bitrate, name, lang
+            )
+        res = BytesIO()
+        res.write(bytes(res_str, "utf-8"))
+        res.seek(0)
+        return res
+
     def oovideo_stream(self, **kwargs):
         self.ensure_one()
+        if kwargs.get("res") == "auto" and self._get_renditions():
+            return self._oovideo_master_playlist(**kwargs)
         bitrate = kwargs.get("br", "500")
         resolution = kwargs.get("res", "360p")
         if resolution not in RES_LIST.keys():
@@ -80,19 +384,20 @@ class VideoMedia(models.Model):
         else:
             resolution = RES_LIST[resolution]
         lang = kwargs.get("lang", 1)
+        # Identifies the playback session, i.e. the player which loaded the playlist
+        sid = uuid.uuid4().hex
+        # The session segmenter cuts the media every SEGMENT_DURATION seconds
+        transcoder = self.env.ref("oovideo.oovideo_transcoder_0")
+        segments = self._get_segments(keyframe_aligned=not transcoder.session_mode)
+        target_duration = max([math.ceil(s[1]) for s in segments] + [SEGMENT_DURATION])
         res_str = ""
         res_str += "#EXTM3U\n"
-        res_str += "#EXT-X-VERSION:1\n"
-        res_str += "#EXT-X-TARGETDURATION:10\n"
-        total_duration = self.duration // 1000
-        remaining_duration = total_duration
-        while remaining_duration > 0:
-            seek = total_duration - remaining_duration
-            remaining_duration -= 10
-            duration = 10 if remaining_duration >= 0 else remaining_duration + 10
+        res_str += "#EXT-X-VERSION:3\n"
+        res_str += "#EXT-X-TARGETDURATION:%s\n" % (target_duration)
+        for seek, duration in segments:
             res_str += "#EXTINF:%s,\n" % (duration)
-            res_str += "/oovideo/trans/{}.ts?seek={}&dur={}&br={}&res={}&lang={}\n".format(
-                self.id, seek, duration, bitrate, resolution, lang
+            res_str += "/oovideo/trans/{}.ts?seek={}&dur={}&br={}&res={}&lang={}&sid={}\n".format(
+                self.id, seek, duration, bitrate, resolution, lang, sid
             )
         res_str += "#EXT-X-ENDLIST"
         res = BytesIO()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+
+
+class VideoMediaError(models.Model):
+    _name = "oovideo.media.error"
+    _description = "Video Media Error"
+    _order = "path"
+
+    name = fields.Char("File Name", required=True)
+    path = fields.Char("Path", required=True)
+    error = fields.Char("Error")
+    last_modification = fields.Integer("Last Modification")
+    fingerprint = fields.Char("Fingerprint", help="Device, inode and size of the file")
+    root_folder_id = fields.Many2one(
+        "oovideo.folder", string="Root Folder", required=True, index=True, ondelete="cascade"
+    )
+    user_id = fields.Many2one(
+        "res.users",
+        string="User",
+        index=True,
+        required=True,
+        ondelete="cascade",
+        default=lambda self: self.env.user,
+    )
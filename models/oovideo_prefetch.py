@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+from .oovideo_scheduler import PRIORITY_PREFETCH, scheduler
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of prefetch processes running at the same time in the process
+MAX_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# Maximum number of prefetch processes running at the same time for a single session
+SESSION_CAP = 1
+# The prefetch jobs of sessions which have not requested anything for this number of seconds are
+# cancelled
+IDLE_TIMEOUT = 60
+
+
+class PrefetchJob(object):
+    """
+    Transcode a segment in the background, and store it in the segment cache.
+    """
+
+    def __init__(self, key, cmd, cache):
+        """
+        :param str key: key of the segment in the cache
+        :param list cmd: transcoding command
+        :param FileCache cache: segment cache
+        """
+        self.key = key
+        self.cmd = cmd
+        self.cache = cache
+        self.sid = None
+        self.proc = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def run(self):
+        # Wait for a transcoding slot, unless the job is cancelled in the meantime
+        while self.proc is None:
+            if self.cancelled:
+                return
+            try:
+                self.proc = scheduler.popen(self.cmd, PRIORITY_PREFETCH, timeout=5)
+            except TimeoutError:
+                continue
+        if self.cancelled:
+            scheduler.release(self.proc)
+            return
+        writer = self.cache.writer(self.key)
+        try:
+            for chunk in iter(lambda: self.proc.stdout.read(8192), b""):
+                writer.write(chunk)
+            if self.proc.wait() == 0 and not self.cancelled:
+                writer.commit()
+        finally:
+            writer.abort()
+            scheduler.release(self.proc)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+
+
+class PrefetchPool(object):
+    """
+    Process-wide pool of workers transcoding the next segments of the playback sessions.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, session_cap=SESSION_CAP):
+        self.max_workers = max_workers
+        self.session_cap = session_cap
+        self.queue = []
+        self.jobs = {}
+        self.sessions = {}
+        self.cond = threading.Condition()
+        self.workers = []
+
+    def _session(self, sid):
+        return self.sessions.setdefault(sid, {"last_access": time.time(), "running": 0})
+
+    def _cancel(self, job):
+        job.cancel()
+        if job in self.queue:
+            self.queue.remove(job)
+            self.jobs.pop(job.key, None)
+            job.done.set()
+
+    def _reap(self):
+        limit = time.time() - IDLE_TIMEOUT
+        for sid in [s for s, v in self.sessions.items() if v["last_access"] < limit]:
+            for job in [j for j in self.jobs.values() if j.sid == sid]:
+                self._cancel(job)
+            if not self.sessions[sid]["running"]:
+                del self.sessions[sid]
+
+    def _next_job(self):
+        for job in self.queue:
+            if self.sessions[job.sid]["running"] < self.session_cap:
+                self.queue.remove(job)
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                self._reap()
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait(5)
+                    self._reap()
+                    job = self._next_job()
+                self.sessions[job.sid]["running"] += 1
+            try:
+                job.run()
+            except Exception:
+                _logger.warning("Error while prefetching segment", exc_info=1)
+            finally:
+                with self.cond:
+                    self.sessions[job.sid]["running"] -= 1
+                    self.jobs.pop(job.key, None)
+                    job.done.set()
+                    self.cond.notify_all()
+
+    def submit(self, sid, jobs, current=None):
+        """
+        Submit the prefetch jobs of a session. The jobs previously submitted for the session which
+        are not part of the new jobs are cancelled, since the client seeked elsewhere. The job of
+        the segment currently requested is kept, since the client waits for it.
+
+        :param sid: identifier of the session
+        :param list jobs: PrefetchJob to execute, in order of priority
+        :param str current: key of the segment currently requested
+        """
+        with self.cond:
+            session = self._session(sid)
+            session["last_access"] = time.time()
+            keys = {job.key for job in jobs} | {current}
+            for job in [j for j in self.jobs.values() if j.sid == sid and j.key not in keys]:
+                self._cancel(job)
+            for job in jobs:
+                if job.key in self.jobs:
+                    continue
+                job.sid = sid
+                self.jobs[job.key] = job
+                self.queue.append(job)
+            self.workers = [w for w in self.workers if w.is_alive()]
+            while len(self.workers) < min(self.max_workers, len(self.queue)):
+                worker = threading.Thread(target=self._work, name="oovideo.prefetch")
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.cond.notify_all()
+
+    def wait(self, key, timeout=30):
+        """
+        Wait for the prefetch job of a segment. If the job did not start transcoding yet, it is
+        cancelled since the caller will transcode the segment itself: the job may still be waiting
+        for a slot, which is granted to prefetch jobs after the interactive requests.
+
+        :param str key: key of the segment in the cache
+        :param int timeout: maximum number of seconds to wait
+        :return bool: True if the segment was prefetched in the meantime
+        """
+        with self.cond:
+            job = self.jobs.get(key)
+            if job is None:
+                return False
+            if job.proc is None:
+                self._cancel(job)
+                return False
+        return job.done.wait(timeout) and not job.cancelled
+
+
+prefetch_pool = PrefetchPool()
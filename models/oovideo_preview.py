@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import os
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of preview generations running at the same time in the process
+MAX_WORKERS = 1
+# A thumbnail is taken every this number of seconds...
+THUMB_INTERVAL = 10
+# ... unless the sprite would contain more thumbnails than this number
+MAX_THUMBS = 400
+# Width of a thumbnail, in pixels
+THUMB_WIDTH = 160
+# Number of thumbnails per row of the sprite
+THUMB_COLUMNS = 10
+# Maximum number of seconds a preview generation may take
+TIMEOUT = 600
+
+
+def get_preview_paths(directory, stamp):
+    """
+    Return the paths of the sprite and of the WebVTT track of a media.
+
+    :param str directory: preview directory of the media
+    :param stamp: last modification date of the media
+    :return tuple: paths of the sprite and of the track
+    """
+    return (os.path.join(directory, "%s.jpg" % stamp), os.path.join(directory, "%s.vtt" % stamp))
+
+
+def _format_time(seconds):
+    return "%02d:%02d:%06.3f" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class PreviewJob(object):
+    """
+    Generate the thumbnail sprite of a media and the WebVTT track describing it. Only the
+    keyframes are decoded, which makes the generation much cheaper than a full decoding. The
+    cues of the track reference the sprite relatively, with the media fragment `#xywh`.
+    """
+
+    def __init__(self, path, duration, width, height, directory, stamp, sprite_url):
+        """
+        :param str path: path of the media
+        :param int duration: duration of the media, in seconds
+        :param int width: width of the media
+        :param int height: height of the media
+        :param str directory: preview directory of the media
+        :param stamp: last modification date of the media
+        :param str sprite_url: URL of the sprite, relative to the URL of the track
+        """
+        self.path = path
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.directory = directory
+        self.stamp = stamp
+        self.sprite_url = sprite_url
+
+    def _get_command(self, sprite, interval, rows, thumb_height):
+        cmd = ["nice", "-n", "19"] if shutil.which("nice") else []
+        cmd += ["ionice", "-c", "3"] if shutil.which("ionice") else []
+        cmd += [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-skip_frame",
+            "nokey",
+            "-i",
+            self.path,
+            "-an",
+            "-sn",
+            "-vf",
+            "fps=1/%s,scale=%s:%s,tile=%sx%s"
+            % (interval, THUMB_WIDTH, thumb_height, THUMB_COLUMNS, rows),
+            "-frames:v",
+            "1",
+            "-q:v",
+            "5",
+            "-y",
+            sprite,
+        ]
+        return cmd
+
+    def run(self):
+        if not self.duration or not self.width or not self.height:
+            return
+        interval = max(THUMB_INTERVAL, int(math.ceil(self.duration / MAX_THUMBS)))
+        count = int(math.ceil(self.duration / interval))
+        rows = int(math.ceil(count / THUMB_COLUMNS))
+        thumb_height = max(2, int(round(THUMB_WIDTH * self.height / self.width / 2)) * 2)
+
+        # Remove the previews of the former versions of the media
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        sprite, track = get_preview_paths(self.directory, self.stamp)
+        tmp_sprite = os.path.join(self.directory, "tmp.jpg")
+        cmd = self._get_command(tmp_sprite, interval, rows, thumb_height)
+        try:
+            subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=TIMEOUT,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError):
+            _logger.warning('Error while generating the preview of "%s"', self.path, exc_info=1)
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return
+
+        lines = ["WEBVTT", ""]
+        for i in range(count):
+            x = (i % THUMB_COLUMNS) * THUMB_WIDTH
+            y = (i // THUMB_COLUMNS) * thumb_height
+            lines.append(
+                "%s --> %s"
+                % (_format_time(i * interval), _format_time(min((i + 1) * interval, self.duration)))
+            )
+            lines.append("%s#xywh=%s,%s,%s,%s" % (self.sprite_url, x, y, THUMB_WIDTH, thumb_height))
+            lines.append("")
+        with open(track + ".tmp", "w") as f:
+            f.write("\n".join(lines))
+        # The track is written last, since its presence means the preview is ready
+        os.replace(tmp_sprite, sprite)
+        os.replace(track + ".tmp", track)
+
+
+class PreviewQueue(object):
+    """
+    Process-wide queue of the preview generations. A bounded number of workers execute the jobs
+    in order of submission, with the lowest CPU and I/O priorities, so the previews never compete
+    with the playback. A media submitted again while waiting is only generated once.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self.jobs = OrderedDict()
+        self.cond = threading.Condition()
+        self.workers = []
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                dummy, job = self.jobs.popitem(last=False)
+            try:
+                job.run()
+            except Exception:
+                _logger.warning("Error while generating preview", exc_info=1)
+
+    def submit(self, jobs):
+        """
+        Submit preview jobs.
+
+        :param list jobs: PreviewJob to execute
+        """
+        with self.cond:
+            for job in jobs:
+                self.jobs[job.directory] = job
+            self.workers = [w for w in self.workers if w.is_alive()]
+            while len(self.workers) < min(self.max_workers, len(self.jobs)):
+                worker = threading.Thread(target=self._work, name="oovideo.preview")
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.cond.notify_all()
+
+
+preview_queue = PreviewQueue()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Priorities of the transcoding processes. The lower the value, the higher the priority.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_PREFETCH: "prefetch"}
+# Maximum number of transcoding processes running at the same time in the process
+MAX_RUNNING = os.cpu_count() or 1
+# Maximum number of seconds a player request waits for a transcoding slot
+SLOT_TIMEOUT = 30
+
+
+class TranscodeScheduler(object):
+    """
+    Process-wide scheduler of the transcoding processes. It limits the number of processes
+    running at the same time, and admits the waiting processes by order of priority, then by
+    order of arrival.
+
+    Every process started through the scheduler must be released with `release`, which kills it
+    if it is still running, e.g. because the client disconnected. A process can be suspended to
+    free its slot while it is not needed, then resumed once a slot is available again.
+    """
+
+    def __init__(self, max_running=MAX_RUNNING):
+        self.max_running = max_running
+        self.queue = []
+        self.running = {}
+        self.suspended = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def _wait_slot(self, priority, timeout):
+        """
+        Wait for a free slot. Must be called with the condition acquired.
+
+        :param int priority: priority of the process
+        :param int timeout: maximum number of seconds to wait for a slot, None to wait forever
+        :raises TimeoutError: if no slot was available in time
+        """
+        ticket = (priority, next(self.counter))
+        deadline = None if timeout is None else time.time() + timeout
+        heapq.heappush(self.queue, ticket)
+        try:
+            while self.queue[0] != ticket or len(self.running) >= self.max_running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No transcoding slot available")
+                self.cond.wait(remaining)
+        finally:
+            self.queue.remove(ticket)
+            heapq.heapify(self.queue)
+            self.cond.notify_all()
+
+    def popen(self, cmd, priority=PRIORITY_INTERACTIVE, timeout=None, **kwargs):
+        """
+        Wait for a free slot, then start a transcoding process. The standard output is redirected
+        to a pipe, and the error output is discarded.
+
+        :param list cmd: command to execute
+        :param int priority: priority of the process
+        :param int timeout: maximum number of seconds to wait for a slot, None to wait forever
+        :param kwargs: extra arguments passed to `subprocess.Popen`
+        :return subprocess.Popen: process started
+        :raises TimeoutError: if no slot was available in time
+        """
+        with self.cond:
+            self._wait_slot(priority, timeout)
+            kwargs.setdefault("stdout", subprocess.PIPE)
+            proc = subprocess.Popen(cmd, stderr=subprocess.DEVNULL, **kwargs)
+            self.running[proc.pid] = (proc, priority)
+        return proc
+
+    def suspend(self, proc):
+        """
+        Stop a running process with SIGSTOP, and free its slot.
+
+        :param subprocess.Popen proc: process to suspend
+        """
+        with self.cond:
+            if proc.pid not in self.running:
+                return
+            proc.send_signal(signal.SIGSTOP)
+            self.suspended[proc.pid] = self.running.pop(proc.pid)
+            self.cond.notify_all()
+
+    def resume(self, proc, timeout=None):
+        """
+        Wait for a free slot, then continue a suspended process with SIGCONT.
+
+        :param subprocess.Popen proc: process to resume
+        :param int timeout: maximum number of seconds to wait for a slot, None to wait forever
+        :raises TimeoutError: if no slot was available in time
+        """
+        with self.cond:
+            if proc.pid not in self.suspended:
+                return
+            self._wait_slot(self.suspended[proc.pid][1], timeout)
+            self.running[proc.pid] = self.suspended.pop(proc.pid)
+            proc.send_signal(signal.SIGCONT)
+
+    def release(self, proc):
+        """
+        Release the slot of a process. The process is killed if it is still running.
+
+        :param subprocess.Popen proc: process to release
+        """
+        if proc.poll() is None:
+            _logger.debug("Killing transcoding process %s", proc.pid)
+            proc.kill()
+        proc.wait()
+        if proc.stdout is not None:
+            proc.stdout.close()
+        with self.cond:
+            self.running.pop(proc.pid, None)
+            self.suspended.pop(proc.pid, None)
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        Return the number of running and queued processes, by priority.
+
+        :return dict: statistics of the scheduler
+        """
+        with self.cond:
+            res = {
+                "max_running": self.max_running,
+                "running": {name: 0 for name in PRIORITY_NAMES.values()},
+                "queued": {name: 0 for name in PRIORITY_NAMES.values()},
+            }
+            for proc, priority in self.running.values():
+                res["running"][PRIORITY_NAMES[priority]] += 1
+            for priority, dummy in self.queue:
+                res["queued"][PRIORITY_NAMES[priority]] += 1
+        return res
+
+
+scheduler = TranscodeScheduler()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from .oovideo_scheduler import PRIORITY_INTERACTIVE, SLOT_TIMEOUT, scheduler
+
+_logger = logging.getLogger(__name__)
+
+# Name of the list of completed segments written by the segmenter
+SEGMENT_LIST = "segments.csv"
+# A client requesting a segment up to this number of segments after the last produced one is
+# considered as playing normally: we wait for the segmenter instead of restarting it.
+SEEK_TOLERANCE = 3
+# Maximum number of segments produced ahead of the last requested one. Beyond this limit, the
+# segmenter is paused until the client catches up.
+MAX_AHEAD = 30
+# Sessions which have not been accessed for this number of seconds are stopped
+IDLE_TIMEOUT = 120
+# Maximum number of seconds to wait for a segment
+SEGMENT_TIMEOUT = 60
+
+
+class SegmenterSession(object):
+    """
+    A playback session, backed by a single ffmpeg process running in segmenter mode. The process
+    writes the segments in the session directory, starting from a given segment number.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.proc = None
+        self.start = 0
+        self.paused = False
+        self.last_access = time.time()
+        self.last_requested = 0
+        self.lock = threading.Lock()
+
+    def produced(self):
+        """
+        Read the list of segments completed by the segmenter.
+
+        :return set: numbers of the completed segments
+        """
+        res = set()
+        try:
+            with open(os.path.join(self.directory, SEGMENT_LIST)) as f:
+                for line in f:
+                    fn = line.split(",")[0]
+                    if fn:
+                        res.add(int(os.path.splitext(fn)[0]))
+        except (OSError, ValueError):
+            pass
+        return res
+
+    def segment_path(self, number, suffix):
+        return os.path.join(self.directory, "%06d%s" % (number, suffix))
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def restart(self, number, cmd):
+        """
+        (Re)start the segmenter so it produces segments from the given segment number.
+
+        :param int number: number of the first segment to produce
+        :param list cmd: command of the segmenter
+        :raises TimeoutError: if no transcoding slot was available in time
+        """
+        self.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        self.start = number
+        self.proc = scheduler.popen(
+            cmd,
+            PRIORITY_INTERACTIVE,
+            timeout=SLOT_TIMEOUT,
+            stdout=subprocess.DEVNULL,
+            cwd=self.directory,
+        )
+
+    def resume(self, timeout=SLOT_TIMEOUT):
+        """
+        Continue a paused segmenter, once a transcoding slot is available.
+
+        :param int timeout: maximum number of seconds to wait for a slot
+        :raises TimeoutError: if no transcoding slot was available in time
+        """
+        if self.paused and self.running():
+            scheduler.resume(self.proc, timeout=timeout)
+        self.paused = False
+
+    def pause(self):
+        """
+        Pause the segmenter. Its transcoding slot is freed until it is resumed.
+        """
+        if not self.paused and self.running():
+            scheduler.suspend(self.proc)
+            self.paused = True
+
+    def stop(self):
+        # A paused process is killed as well, without taking a slot
+        if self.proc is not None:
+            scheduler.release(self.proc)
+        self.proc = None
+        self.paused = False
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SessionManager(object):
+    """
+    Process-wide registry of the playback sessions. A reaper thread pauses the segmenters which
+    are too far ahead of their client, and stops the idle sessions.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def _start_reaper(self):
+        if self.reaper is None or not self.reaper.is_alive():
+            self.reaper = threading.Thread(target=self._reap, name="oovideo.session.reaper")
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(5)
+            with self.lock:
+                sessions = list(self.sessions.items())
+            for key, session in sessions:
+                with session.lock:
+                    if time.time() - session.last_access > IDLE_TIMEOUT:
+                        session.stop()
+                        with self.lock:
+                            self.sessions.pop(key, None)
+                    elif session.running():
+                        produced = session.produced()
+                        if produced and max(produced) > session.last_requested + MAX_AHEAD:
+                            session.pause()
+                    elif session.proc is not None:
+                        # The segmenter reached the end of the media, free its slot
+                        scheduler.release(session.proc)
+
+    def get_segment(self, key, directory, number, suffix, cmd_builder):
+        """
+        Return the path of a segment produced by the segmenter of the session `key`. The
+        segmenter is (re)started if the requested segment is outside the window being produced,
+        and resumed if it was paused. A segment already produced is returned without waiting for a
+        transcoding slot.
+
+        :param key: key of the session
+        :param str directory: directory of the session
+        :param int number: number of the segment
+        :param str suffix: extension of the segment files
+        :param cmd_builder: function returning the command of the segmenter, given the number of
+            the first segment and the session directory
+        :return str: path of the segment, or None if the segmenter did not produce it in time
+        :raises TimeoutError: if no transcoding slot was available to (re)start the segmenter
+        """
+        with self.lock:
+            session = self.sessions.setdefault(key, SegmenterSession(directory))
+            self._start_reaper()
+
+        with session.lock:
+            session.last_access = time.time()
+            session.last_requested = number
+            produced = session.produced()
+            if number not in produced:
+                last = max(produced) if produced else session.start - 1
+                if (
+                    not session.running()
+                    or number < session.start
+                    or number > last + SEEK_TOLERANCE
+                ):
+                    _logger.debug('Starting segmenter of session "%s" at %s', key, number)
+                    session.restart(number, cmd_builder(number, directory))
+                session.resume()
+            elif session.paused and max(produced) <= number + MAX_AHEAD:
+                # The segment is served right away: the client caught up with a paused segmenter,
+                # which is only resumed if a slot is free. Otherwise, the next request retries.
+                try:
+                    session.resume(timeout=0)
+                except TimeoutError:
+                    pass
+
+        deadline = time.time() + SEGMENT_TIMEOUT
+        while time.time() < deadline:
+            if number in session.produced():
+                return session.segment_path(number, suffix)
+            if not session.running():
+                break
+            time.sleep(0.2)
+        # The segmenter may have completed the last segment right before exiting
+        if number in session.produced():
+            return session.segment_path(number, suffix)
+        return None
+
+
+session_manager = SessionManager()
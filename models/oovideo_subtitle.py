@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import os
+import re
+
+from odoo import fields, models
+from odoo.tools.sql import table_exists
+
+from .oovideo_cache import FileCache, get_cache_dir
+
+try:
+    from webvtt import webvtt
+except ImportError:
+    webvtt = None
+
+_logger = logging.getLogger(__name__)
+
+SUBTITLE_EXTENSIONS = {"srt", "vtt", "sbv"}
+# Language codes recognized in the subtitle file names, e.g. "Movie.en.srt" or "Movie.French.srt"
+LANGUAGES = {
+    "ar": ("ara", "arabic"),
+    "cs": ("ces", "cze", "czech"),
+    "da": ("dan", "danish"),
+    "de": ("deu", "ger", "german", "deutsch"),
+    "el": ("ell", "gre", "greek"),
+    "en": ("eng", "english"),
+    "es": ("spa", "spanish", "espanol"),
+    "fi": ("fin", "finnish"),
+    "fr": ("fra", "fre", "french", "francais"),
+    "he": ("heb", "hebrew"),
+    "hu": ("hun", "hungarian"),
+    "it": ("ita", "italian", "italiano"),
+    "ja": ("jpn", "japanese"),
+    "ko": ("kor", "korean"),
+    "nl": ("nld", "dut", "dutch"),
+    "no": ("nor", "norwegian"),
+    "pl": ("pol", "polish"),
+    "pt": ("por", "portuguese"),
+    "ro": ("ron", "rum", "romanian"),
+    "ru": ("rus", "russian"),
+    "sv": ("swe", "swedish"),
+    "tr": ("tur", "turkish"),
+    "zh": ("zho", "chi", "chinese"),
+}
+LANGUAGE_TOKENS = {t: code for code, tokens in LANGUAGES.items() for t in tokens + (code,)}
+
+
+def guess_language(file_name, media_name):
+    """
+    Guess the language of a subtitle file from the part of its name following the name of the
+    media, e.g. "en" in "Movie.en.srt" for "Movie.mkv".
+
+    :param str file_name: name of the subtitle file
+    :param str media_name: name of the media file
+    :return str: ISO 639-1 code of the language, "und" if unknown
+    """
+    base = os.path.splitext(media_name)[0]
+    suffix = os.path.splitext(file_name)[0][len(base) :]
+    for token in reversed(re.split(r"[\W_]+", suffix.lower())):
+        if token in LANGUAGE_TOKENS:
+            return LANGUAGE_TOKENS[token]
+    return "und"
+
+
+class VideoSubtitle(models.Model):
+    _name = "oovideo.subtitle"
+    _description = "Video Subtitle"
+    _order = "name"
+
+    name = fields.Char("File Name", required=True)
+    path = fields.Char("Path", required=True)
+    lang = fields.Char("Language", default="und", help="ISO 639-1 code, 'und' if unknown")
+    media_id = fields.Many2one(
+        "oovideo.media", string="Media", required=True, index=True, ondelete="cascade"
+    )
+    user_id = fields.Many2one(
+        "res.users",
+        string="User",
+        index=True,
+        required=True,
+        ondelete="cascade",
+        default=lambda self: self.env.user,
+    )
+
+    def _auto_init(self):
+        new_table = not table_exists(self.env.cr, self._table)
+        res = super(VideoSubtitle, self)._auto_init()
+        if new_table:
+            # The directories scanned before the subtitles were indexed must be listed again
+            self.env.cr.execute("UPDATE oovideo_folder SET last_modification = 0")
+        return res
+
+    def _get_subtitle_cache(self):
+        """
+        Return the cache of the subtitles converted to WebVTT. Its size is limited by the system
+        parameter `oovideo.subtitle_cache_size`, in MB.
+
+        :return FileCache: cache of the subtitles
+        """
+        max_size = int(
+            self.env["ir.config_parameter"].sudo().get_param("oovideo.subtitle_cache_size", 100)
+        )
+        return FileCache(
+            get_cache_dir(self.env.cr.dbname, "subtitles"), max_size * 1024 * 1024, suffix=".vtt"
+        )
+
+    def _get_vtt_path(self):
+        """
+        Get the subtitle in WebVTT format. A WebVTT file is returned as is, while SRT and SBV
+        files are converted once and kept in the subtitle cache. The cache key includes the
+        modification date and size of the file, so a modified file is converted again.
+
+        :return str: path of the WebVTT file, or None if the subtitle cannot be served
+        """
+        self.ensure_one()
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        ext = os.path.splitext(self.path)[1].lower()
+        if ext == ".vtt":
+            return self.path
+        if ext not in (".srt", ".sbv") or not webvtt:
+            return None
+
+        cache = self._get_subtitle_cache()
+        key = FileCache.make_key(self.path, st.st_mtime, st.st_size)
+        path = cache.get(key)
+        if path:
+            return path
+
+        buf = io.StringIO()
+        try:
+            if ext == ".srt":
+                webvtt.WebVTT().from_srt(self.path).write(buf)
+            else:
+                webvtt.WebVTT().from_sbv(self.path).write(buf)
+        except Exception:
+            _logger.warning('Error while converting subtitle "%s"', self.path, exc_info=1)
+            return None
+        writer = cache.writer(key)
+        try:
+            writer.write(buf.getvalue().encode("utf-8"))
+            writer.commit()
+        finally:
+            writer.abort()
+        return cache.path(key)
@@ -2,11 +2,24 @@
 
 from collections import OrderedDict
 import datetime
+import logging
 import os
-import subprocess
+import shutil
+import time
 
-from odoo import fields, models
+from odoo import api, fields, models
 
+from .oovideo_cache import FileCache, get_cache_dir
+from .oovideo_prefetch import PrefetchJob, prefetch_pool
+from .oovideo_scheduler import PRIORITY_INTERACTIVE, SLOT_TIMEOUT, scheduler
+from .oovideo_session import SEGMENT_LIST, session_manager
+
+_logger = logging.getLogger(__name__)
+
+# Duration of the HLS segments, in seconds
+SEGMENT_DURATION = 10
+# Session directories older than this number of seconds are removed by the cache cleaning
+SESSION_MAX_AGE = 86400
 BR_LIST = [200, 300, 400, 500, 700, 1200, 1500, 1700, 2000, 2500, 3000, 4000, 5000, 6000]
 RES_LIST = OrderedDict(
     [
@@ -18,6 +31,10 @@ RES_LIST = OrderedDict(
         ("1080p", "1920x1080"),
     ]
 )
+# Video bitrate of each resolution of the adaptive-bitrate ladder, in kbps
+RES_BITRATE = {"144p": 200, "240p": 400, "360p": 700, "480p": 1200, "720p": 2500, "1080p": 5000}
+# Bitrate added to the video bitrate to estimate the bandwidth of a rendition, in kbps
+AUDIO_BITRATE = 128
 
 
 class VideoTranscoder(models.Model):
@@ -51,20 +68,125 @@ class VideoTranscoder(models.Model):
         "oovideo.format", string="Input Formats", required=True, index=True
     )
     output_format = fields.Many2one("oovideo.format", string="Output Format", required=True)
+    remux_command = fields.Char(
+        "Remux Command line",
+        help="""Command to execute when the tracks of the media can be copied as is, i.e. H.264
+        video with AAC or MP3 audio, played at the original resolution and bitrate. The keyframes
+        of the media must be indexed. The same keywords as the command line are replaced.
+        Not used in session mode.""",
+    )
+    session_mode = fields.Boolean(
+        "Session Segmenter",
+        default=False,
+        help="Run a single segmenter process per playback session, which produces the segments "
+        "ahead of the player. Otherwise, a new process is executed for each segment.",
+    )
+    session_command = fields.Char(
+        "Segmenter Command line",
+        help="""Command to execute for the session segmenter. The same keywords as the command
+        line are replaced, as well as:
+        - "%n": number of the first segment
+        - "%o": output file pattern of the segments
+        - "%c": list of the completed segments, in CSV format
+        """,
+    )
+    prefetch_segments = fields.Integer(
+        "Prefetch Segments",
+        default=2,
+        help="Number of segments transcoded in the background after the segment requested by the "
+        "player. Set to 0 to deactivate prefetching.",
+    )
     buffer_size = fields.Integer(
         "Buffer Size (KB)",
         required=True,
         default=1000,
         help="""Size of the buffer used while streaming. A larger value can reduce the potential
-        file download errors when playing.""",
+        file download errors when playing. The first bytes produced by the transcoder are always
+        sent immediately, without waiting for the buffer to be full.""",
     )
 
+    def _get_transcode_params(self, **kwargs):
+        """
+        Extract the transcoding parameters from the request parameters, with their default values.
+
+        :return tuple: seek, duration, bitrate, resolution, language
+        """
+        seek = float(kwargs.get("seek", 0))
+        duration = float(kwargs.get("dur", SEGMENT_DURATION))
+        bitrate = str(kwargs.get("br", self.bitrate))
+        resolution = str(kwargs.get("res", "640x360"))
+        lang = str(kwargs.get("lang", "1"))
+        return seek, duration, bitrate, resolution, lang
+
+    def _get_segment_key(self, media, **kwargs):
+        """
+        Build the key of a segment in the segment cache. The key includes the last modification
+        dates of the media and of the transcoder, so a modified file, or a modified command, is
+        transcoded again.
+
+        :param media: media to transcode
+        :return str: key of the segment
+        """
+        return FileCache.make_key(
+            media.id,
+            media.last_modification,
+            self._get_transcode_params(**kwargs),
+            self.id,
+            str(self.write_date),
+        )
+
+    def _get_segment_cache(self):
+        """
+        Return the cache of the transcoded segments. Its size is limited by the system parameter
+        `oovideo.segment_cache_size`, in MB.
+
+        :return FileCache: cache of the segments
+        """
+        max_size = int(
+            self.env["ir.config_parameter"].sudo().get_param("oovideo.segment_cache_size", 2048)
+        )
+        return FileCache(
+            get_cache_dir(self.env.cr.dbname, "segments"),
+            max_size * 1024 * 1024,
+            suffix="." + self.output_format.name,
+        )
+
+    @api.model
+    def cron_clean_cache(self):
+        """
+        Remove the cache entries which were not used for `oovideo.cache_max_age` days (30 by
+        default), the session directories left behind by a stopped server, and the previews of the
+        deleted media.
+        """
+        max_age = int(self.env["ir.config_parameter"].sudo().get_param("oovideo.cache_max_age", 30))
+        self._get_segment_cache().prune(max_age * 86400)
+        self.env["oovideo.subtitle"]._get_subtitle_cache().prune(max_age * 86400)
+
+        sessions_dir = get_cache_dir(self.env.cr.dbname, "sessions")
+        if os.path.isdir(sessions_dir):
+            for entry in os.scandir(sessions_dir):
+                try:
+                    if entry.stat().st_mtime < time.time() - SESSION_MAX_AGE:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                except OSError:
+                    pass
+
+        # Remove the previews of the deleted media
+        previews_dir = get_cache_dir(self.env.cr.dbname, "previews")
+        if os.path.isdir(previews_dir):
+            self.env.cr.execute("SELECT id FROM oovideo_media")
+            media_ids = {str(r[0]) for r in self.env.cr.fetchall()}
+            for entry in os.scandir(previews_dir):
+                if entry.name not in media_ids:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
     def transcode(self, media_id, **kwargs):
         """
         Method used to transcode a track. It takes in charge the replacement of the specific
         keywords of the command, and returns the subprocess executed. The subprocess output is
         redirected to stdout, so it is possible to stream the transcoding result while it is still
-        ongoing.
+        ongoing. The process is started through the transcoding scheduler, and must be released
+        with `scheduler.release` once done.
         Extra parameters should be specified:
         - 'seek': start time of the transcoding
         - 'dur': duration to transcode
@@ -75,17 +197,30 @@ class VideoTranscoder(models.Model):
         :param media_id: ID of the media to transcode
         :returns: subprocess redirected to stdout.
         :rtype: subprocess.Popen
+        :raises TimeoutError: if no transcoding slot was available in time
         """
         self.ensure_one()
-        seek = int(kwargs.get("seek", 0))
-        duration = kwargs.get("dur", "10")
-        bitrate = kwargs.get("br", self.bitrate)
-        resolution = kwargs.get("res", "640x360")
-        lang = kwargs.get("lang", "1")
-
         media = self.env["oovideo.media"].browse([media_id])
+        cmd = self._get_transcode_command(media, **kwargs)
+        proc = scheduler.popen(cmd, PRIORITY_INTERACTIVE, timeout=SLOT_TIMEOUT)
+        return proc
+
+    def _get_transcode_command(self, media, **kwargs):
+        """
+        Build the transcoding command, replacing the specific keywords.
+
+        :param media: media to transcode
+        :return list: command to execute
+        """
+        seek, duration, bitrate, resolution, lang = self._get_transcode_params(**kwargs)
+        command = self.command
+        if self.remux_command and not self.session_mode and media._can_remux(bitrate, resolution):
+            command = self.remux_command
+            # The keyframes are indexed in truncated milliseconds: make sure the seek does not fall
+            # right before the keyframe starting the segment, which would copy the previous one.
+            seek += 0.001
         cmd = (
-            self.command.replace("%s", "%s" % (str(datetime.timedelta(seconds=seek))))
+            command.replace("%s", "%s" % (str(datetime.timedelta(seconds=seek))))
             .replace("%d", "%s" % (duration))
             .replace("%r", "%s" % (resolution))
             .replace("%b", "%s" % (bitrate))
@@ -93,6 +228,220 @@ class VideoTranscoder(models.Model):
         )
         cmd = cmd.split(" ")
         cmd[cmd.index("%i")] = media.path
+        return cmd
 
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
-        return proc
+    def _get_session_command(self, media, number, directory, **kwargs):
+        """
+        Build the command of the session segmenter, starting at the given segment number.
+
+        :param media: media to transcode
+        :param int number: number of the first segment to produce
+        :param str directory: directory of the session
+        :return list: command to execute
+        """
+        seek, duration, bitrate, resolution, lang = self._get_transcode_params(**kwargs)
+        seek = number * SEGMENT_DURATION
+        cmd = (
+            self.session_command.replace("%s", "%s" % (str(datetime.timedelta(seconds=seek))))
+            .replace("%d", "%s" % (SEGMENT_DURATION))
+            .replace("%n", "%s" % (number))
+            .replace("%r", "%s" % (resolution))
+            .replace("%b", "%s" % (bitrate))
+            .replace("%l", "%s" % (lang))
+        )
+        cmd = cmd.split(" ")
+        cmd[cmd.index("%i")] = media.path
+        cmd[cmd.index("%o")] = os.path.join(directory, "%06d." + self.output_format.name)
+        cmd[cmd.index("%c")] = os.path.join(directory, SEGMENT_LIST)
+        return cmd
+
+    def _get_session_segment(self, media, **kwargs):
+        """
+        Get a segment produced by the segmenter of the playback session. The session is
+        identified by the `sid` parameter generated with the playlist.
+
+        :param media: media to transcode
+        :return str: path of the segment, or None if it could not be produced
+        :raises TimeoutError: if no transcoding slot was available in time
+        """
+        seek, duration, bitrate, resolution, lang = self._get_transcode_params(**kwargs)
+        key = (
+            self.env.cr.dbname,
+            kwargs.get("sid") or self.env.uid,
+            media.id,
+            media.last_modification,
+            bitrate,
+            resolution,
+            lang,
+            self.id,
+            str(self.write_date),
+        )
+        directory = get_cache_dir(
+            self.env.cr.dbname, os.path.join("sessions", FileCache.make_key(*key))
+        )
+        return session_manager.get_segment(
+            key,
+            directory,
+            int(seek // SEGMENT_DURATION),
+            "." + self.output_format.name,
+            lambda number, directory: self._get_session_command(media, number, directory, **kwargs),
+        )
+
+    def transcode_segment(self, media_id, **kwargs):
+        """
+        Method used to get a transcoded segment. The segment is served from the segment cache if
+        it was already transcoded with the same parameters. Otherwise, the media is transcoded and
+        the result is stored in the cache while being streamed. In session mode, the segment is
+        produced by the segmenter of the playback session, and copied in the cache.
+
+        Outside of session mode, the next segments are prefetched in the background, whether the
+        requested segment is cached or not. If the requested segment is already being transcoded by
+        the prefetch pool, we wait for it instead of transcoding it a second time. If its job is
+        still waiting for a slot, it is cancelled and the segment is transcoded at interactive
+        priority.
+
+        :param media_id: ID of the media to transcode
+        :returns: iterator on the segment content
+        """
+        self.ensure_one()
+        media = self.env["oovideo.media"].browse([media_id])
+        cache = self._get_segment_cache()
+        key = self._get_segment_key(media, **kwargs)
+        buffer_size = max(self.buffer_size, 1) * 1024
+        prefetch = self.prefetch_segments > 0 and not (self.session_mode and self.session_command)
+        path = cache.get(key)
+        if prefetch:
+            self._prefetch(media, cache, key, **kwargs)
+        if path:
+            return _read_file(path, buffer_size)
+        if self.session_mode and self.session_command:
+            path = self._get_session_segment(media, **kwargs)
+            if path:
+                return _read_file(cache.put(key, path), buffer_size)
+            _logger.warning("Segmenter failed for media ID %s, falling back", media.id)
+            return self._stream_segment(media_id, cache, key, buffer_size, **kwargs)
+
+        if prefetch:
+            if prefetch_pool.wait(key):
+                path = cache.get(key)
+                if path:
+                    return _read_file(path, buffer_size)
+        return self._stream_segment(media_id, cache, key, buffer_size, **kwargs)
+
+    def _stream_segment(self, media_id, cache, key, buffer_size, **kwargs):
+        """
+        Transcode a segment and store it in the cache while streaming it. The cache writer is
+        created before the process, so a failure of the writer never leaves a process running.
+
+        :param media_id: ID of the media to transcode
+        :param FileCache cache: segment cache
+        :param str key: key of the segment
+        :param int buffer_size: size of the chunks to stream, in bytes
+        :returns: iterator on the segment content
+        """
+        writer = cache.writer(key)
+        try:
+            proc = self.transcode(media_id, **kwargs)
+        except Exception:
+            writer.abort()
+            raise
+        return _ProcessStream(proc, writer, buffer_size)
+
+    def _prefetch(self, media, cache, current_key, **kwargs):
+        """
+        Submit the segments following the requested one to the prefetch pool. The segments are
+        transcoded in the background with the same parameters, so they are already in the cache
+        when the player requests them. This also keeps the session alive in the pool.
+
+        :param media: media being played
+        :param FileCache cache: segment cache
+        :param str current_key: key of the requested segment, whose prefetch must not be cancelled
+        """
+        seek = self._get_transcode_params(**kwargs)[0]
+        segments = media._get_segments()
+        index = next((i for i, s in enumerate(segments) if abs(s[0] - seek) < 0.001), None)
+        # A segment off the grid has no known successors, the session is still refreshed
+        following = (
+            segments[index + 1 : index + 1 + self.prefetch_segments] if index is not None else []
+        )
+        jobs = []
+        for seek, duration in following:
+            segment_kwargs = dict(kwargs, seek=seek, dur=duration)
+            key = self._get_segment_key(media, **segment_kwargs)
+            if os.path.isfile(cache.path(key)):
+                continue
+            jobs.append(
+                PrefetchJob(key, self._get_transcode_command(media, **segment_kwargs), cache)
+            )
+        prefetch_pool.submit(kwargs.get("sid") or self.env.uid, jobs, current=current_key)
+
+
+def _read_file(path, chunk_size):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+
+class _ProcessStream(object):
+    """
+    Pump the output of a transcoding process to the client, and write it in a cache entry at the
+    same time. The entry is committed only if the process completed successfully, so an
+    interrupted stream never leaves a partial segment in the cache.
+
+    The output is read with `os.read`, which returns as soon as some data is available: the first
+    bytes are sent immediately, and the following chunks are at most `buffer_size` long. Since
+    the next chunk is only read once the previous one is sent, a slow client slows down the
+    transcoder thanks to the pipe backpressure.
+
+    The WSGI server calls `close` when the response is over, including when the client
+    disconnected. The process is then killed if it is still running, and the statistics of the
+    stream are logged:
+    - bytes streamed;
+    - time to first byte;
+    - time spent waiting for the transcoder;
+    - time spent waiting for the client, i.e. sending the previous chunk.
+    """
+
+    def __init__(self, proc, writer, buffer_size):
+        """
+        :param subprocess.Popen proc: transcoding process
+        :param FileCacheWriter writer: writer of the cache entry
+        :param int buffer_size: maximum size of the chunks, in bytes
+        """
+        self.proc = proc
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.time_start = time.time()
+        self.time_first_byte = None
+        self.bytes_streamed = 0
+        self.transcoder_wait = 0.0
+        self.client_wait = 0.0
+
+    def __iter__(self):
+        fd = self.proc.stdout.fileno()
+        while True:
+            time_read = time.time()
+            chunk = os.read(fd, self.buffer_size)
+            self.transcoder_wait += time.time() - time_read
+            if not chunk:
+                break
+            if self.time_first_byte is None:
+                self.time_first_byte = time.time() - self.time_start
+            self.bytes_streamed += len(chunk)
+            self.writer.write(chunk)
+            time_send = time.time()
+            yield chunk
+            self.client_wait += time.time() - time_send
+        if self.proc.wait() == 0:
+            self.writer.commit()
+
+    def close(self):
+        self.writer.abort()
+        scheduler.release(self.proc)
+        _logger.debug(
+            "Streamed %s bytes: first byte %.3fs, transcoder wait %.3fs, client wait %.3fs",
+            self.bytes_streamed,
+            self.time_first_byte or 0.0,
+            self.transcoder_wait,
+            self.client_wait,
+        )
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+import odoo
+from odoo import SUPERUSER_ID, api
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+_logger = logging.getLogger(__name__)
+
+# Events are applied once no new event was received for this number of seconds...
+DEBOUNCE = 2
+# ... or at the latest this number of seconds after the first pending event
+MAX_DELAY = 30
+# The watched folders are refreshed from the database every this number of seconds
+REFRESH_INTERVAL = 60
+# The changes of a folder being scanned are applied again after this number of seconds, doubled
+# at each attempt up to MAX_RETRY_DELAY
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+
+if INotify is not None:
+    WATCH_MASK = (
+        flags.CREATE
+        | flags.DELETE
+        | flags.MOVED_FROM
+        | flags.MOVED_TO
+        | flags.CLOSE_WRITE
+        | flags.DELETE_SELF
+    )
+
+
+class FolderWatcher(threading.Thread):
+    """
+    Watch the root folders flagged with `watch` of a database thanks to inotify. The events are
+    debounced and coalesced by root folder, then a targeted scan is executed on the directories
+    which changed.
+    """
+
+    def __init__(self, dbname):
+        super(FolderWatcher, self).__init__(name="oovideo.watcher.%s" % dbname)
+        self.daemon = True
+        self.dbname = dbname
+        self.inotify = INotify()
+        # Watch descriptor: (root folder ID, directory path)
+        self.watches = {}
+        # Root folder ID: set of directories which changed
+        self.pending = {}
+        # Root folder ID: (time of the next attempt, delay before the next attempt)
+        self.retries = {}
+        self.first_event = None
+        self.last_event = None
+        self.last_refresh = 0
+
+    def _add_watches(self, folder_id, path):
+        """
+        Watch a directory and all its sub-directories.
+
+        :param int folder_id: ID of the root folder
+        :param str path: path of the directory
+        """
+        stack = [path]
+        while stack:
+            rootdir = stack.pop()
+            try:
+                wd = self.inotify.add_watch(rootdir, WATCH_MASK)
+                self.watches[wd] = (folder_id, rootdir)
+                stack.extend(
+                    e.path for e in os.scandir(rootdir) if e.is_dir() and not e.is_symlink()
+                )
+            except OSError:
+                _logger.warning('Cannot watch folder "%s"', rootdir, exc_info=1)
+
+    def _refresh(self, env):
+        """
+        Synchronize the watches with the root folders to watch.
+        """
+        env.cr.execute("SELECT id, path FROM oovideo_folder WHERE root = true AND watch = true")
+        roots = dict(env.cr.fetchall())
+        watched = {v[0] for v in self.watches.values()}
+        for wd, (folder_id, path) in list(self.watches.items()):
+            if folder_id not in roots:
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+                del self.watches[wd]
+        for folder_id, path in roots.items():
+            if folder_id not in watched:
+                _logger.info('Watching folder "%s"', path)
+                self._add_watches(folder_id, path)
+        self.last_refresh = time.time()
+
+    def _handle(self, event):
+        if event.wd not in self.watches:
+            return
+        folder_id, rootdir = self.watches[event.wd]
+        if event.mask & flags.IGNORED:
+            # The directory was deleted, or unmounted
+            del self.watches[event.wd]
+            return
+        self.pending.setdefault(folder_id, set()).add(rootdir)
+        if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+            self._add_watches(folder_id, os.path.join(rootdir, event.name))
+        self.last_event = time.time()
+        self.first_event = self.first_event or self.last_event
+
+    def _due(self, now):
+        """
+        Check if pending changes must be applied: the events are debounced, and the folders being
+        scanned are retried with a backoff.
+
+        :param float now: current time
+        :return bool: True if at least one folder has changes to apply
+        """
+        if not self.pending:
+            return False
+        if now - self.last_event <= DEBOUNCE and now - self.first_event <= MAX_DELAY:
+            return False
+        return any(self.retries.get(f, (0, 0))[0] <= now for f in self.pending)
+
+    def _apply(self, env):
+        """
+        Scan the directories which changed. The recorded modification date of these directories is
+        reset, so they are listed even if a file was modified in place. The scan starts from the
+        top-most directories only, since the scanner goes through the sub-directories anyway.
+        """
+        for folder_id, dirs in list(self.pending.items()):
+            if self.retries.get(folder_id, (0, 0))[0] > time.time():
+                continue
+            folder = env["oovideo.folder"].browse(folder_id).exists()
+            if not folder:
+                del self.pending[folder_id]
+                self.retries.pop(folder_id, None)
+                continue
+            if folder.locked:
+                # A scan is ongoing, try again later
+                delay = self.retries.get(folder_id, (0, RETRY_DELAY / 2))[1] * 2
+                delay = min(delay, MAX_RETRY_DELAY)
+                self.retries[folder_id] = (time.time() + delay, delay)
+                continue
+            del self.pending[folder_id]
+            self.retries.pop(folder_id, None)
+            env.cr.execute(
+                "UPDATE oovideo_folder SET last_modification = 0 "
+                "WHERE user_id = %s AND path IN %s",
+                (folder.user_id.id, tuple(dirs)),
+            )
+            env.cr.commit()
+            env["oovideo.folder"].invalidate_cache()
+            top_dirs = [
+                d for d in dirs if not any(d.startswith(o + os.sep) for o in dirs if o != d)
+            ]
+            _logger.debug("Changes detected in %s", ", ".join(sorted(top_dirs)))
+            env["oovideo.folder.scan"].with_context(
+                recompute=False, prefetch_fields=False
+            )._scan_folder(folder_id, subpaths=sorted(top_dirs))
+        if not self.pending:
+            self.first_event = None
+            self.last_event = None
+
+    def run(self):
+        registry = odoo.registry(self.dbname)
+        while True:
+            try:
+                for event in self.inotify.read(timeout=1000):
+                    self._handle(event)
+                now = time.time()
+                due = self._due(now)
+                if due or now - self.last_refresh > REFRESH_INTERVAL:
+                    with api.Environment.manage(), registry.cursor() as cr:
+                        env = api.Environment(cr, SUPERUSER_ID, {})
+                        if now - self.last_refresh > REFRESH_INTERVAL:
+                            self._refresh(env)
+                        if due:
+                            self._apply(env)
+            except Exception:
+                _logger.warning("Error while watching folders", exc_info=1)
+                time.sleep(REFRESH_INTERVAL)
+
+
+_watchers = {}
+_lock = threading.Lock()
+
+
+def ensure_watcher(dbname):
+    """
+    Start the watcher of a database in this process if it is not running yet.
+
+    :param str dbname: name of the database
+    :return bool: False if inotify is not available
+    """
+    if INotify is None:
+        return False
+    with _lock:
+        watcher = _watchers.get(dbname)
+        if watcher is None or not watcher.is_alive():
+            watcher = FolderWatcher(dbname)
+            watcher.start()
+            _watchers[dbname] = watcher
+    return True
@@ -28,6 +28,7 @@ import re
 import locale
 import json
 import sys
+import threading
 from pkg_resources import get_distribution, DistributionNotFound
 import xml.etree.ElementTree as ET
 from ctypes import *
@@ -47,6 +48,26 @@ try:
 except DistributionNotFound:
     pass
 
+# Stream kinds of MediaInfo_Get and MediaInfo_Count_Get
+STREAM_KINDS = {"General": 0, "Video": 1, "Audio": 2, "Text": 3, "Other": 4, "Image": 5, "Menu": 6}
+_INFO_TEXT = 1
+_INFO_NAME = 0
+
+# Loaded libraries and their version, by library file
+_libraries = {}
+# Idle MediaInfo handles, by library file. A handle is used by a single thread at a time.
+_handles = {}
+_lock = threading.Lock()
+
+
+def _after_fork():
+    """
+    Reset the lock in a forked process. It might have been held by another thread of the parent
+    process at the time of the fork, and would never be released.
+    """
+    global _lock
+    _lock = threading.Lock()
+
 
 class Track(object):
     """
@@ -201,6 +222,118 @@ class MediaInfo(object):
                 if i == len(library_names):
                     raise
 
+    @classmethod
+    def _get_configured_library(cls, library_file=None):
+        """
+        Load the library and declare the arguments and return types of its functions. This is done
+        once per process, as well as reading the version of the library.
+
+        :param str library_file: path to the libmediainfo library
+        :return tuple: library and its version
+        """
+        with _lock:
+            if library_file in _libraries:
+                return _libraries[library_file]
+            lib = cls._get_library(library_file)
+            lib.MediaInfo_New.argtypes = []
+            lib.MediaInfo_New.restype = c_void_p
+            lib.MediaInfo_Option.argtypes = [c_void_p, c_wchar_p, c_wchar_p]
+            lib.MediaInfo_Option.restype = c_wchar_p
+            lib.MediaInfo_Inform.argtypes = [c_void_p, c_size_t]
+            lib.MediaInfo_Inform.restype = c_wchar_p
+            lib.MediaInfo_Open.argtypes = [c_void_p, c_wchar_p]
+            lib.MediaInfo_Open.restype = c_size_t
+            lib.MediaInfo_Delete.argtypes = [c_void_p]
+            lib.MediaInfo_Delete.restype = None
+            lib.MediaInfo_Close.argtypes = [c_void_p]
+            lib.MediaInfo_Close.restype = None
+            lib.MediaInfo_Get.argtypes = [c_void_p, c_int, c_size_t, c_wchar_p, c_int, c_int]
+            lib.MediaInfo_Get.restype = c_wchar_p
+            lib.MediaInfo_Count_Get.argtypes = [c_void_p, c_int, c_size_t]
+            lib.MediaInfo_Count_Get.restype = c_size_t
+            # Obtain the library version
+            lib_version = lib.MediaInfo_Option(None, "Info_Version", "")
+            lib_version = tuple(
+                int(_)
+                for _ in re.search("^MediaInfoLib - v(\\S+)", lib_version).group(1).split(".")
+            )
+            _libraries[library_file] = (lib, lib_version)
+            _handles[library_file] = []
+            return lib, lib_version
+
+    @classmethod
+    def _acquire_handle(cls, library_file=None):
+        lib, lib_version = cls._get_configured_library(library_file)
+        with _lock:
+            if _handles[library_file]:
+                return _handles[library_file].pop()
+        handle = lib.MediaInfo_New()
+        lib.MediaInfo_Option(handle, "CharSet", "UTF-8")
+        return handle
+
+    @classmethod
+    def _release_handle(cls, handle, library_file=None):
+        lib, lib_version = cls._get_configured_library(library_file)
+        lib.MediaInfo_Close(handle)
+        with _lock:
+            _handles[library_file].append(handle)
+
+    @staticmethod
+    def _check_file(filename):
+        if pathlib is not None and isinstance(filename, pathlib.PurePath):
+            filename = str(filename)
+            url = False
+        else:
+            url = urlparse.urlparse(filename)
+        # Try to open the file (if it's not a URL)
+        # Doesn't work on Windows because paths are URLs
+        if not (url and url.scheme):
+            # Test whether the file is readable
+            with open(filename, "rb"):
+                pass
+        return filename
+
+    @classmethod
+    def query(cls, filename, parameters, library_file=None):
+        """
+        Read some parameters of a media file using libmediainfo, without building the complete
+        XML report. This is much faster than `parse` when only a few parameters are needed.
+
+        >>> pymediainfo.MediaInfo.query("/path/to/file.mp4", {"Video": ["Width", "Height"]})
+        {'Video': [{'Width': '1920', 'Height': '1080'}]}
+
+        :param filename: path to the media file which will be analyzed.
+        :param dict parameters: names of the parameters to read, by stream kind (see
+            `STREAM_KINDS`). The names are the ones of the MediaInfo parameters, e.g. "BitRate".
+        :param str library_file: path to the libmediainfo library
+        :return dict: for each stream kind, the list of the streams, each stream being a dict of
+            the raw values of the parameters. A missing value is None.
+        :raises RuntimeError: if the file cannot be opened by libmediainfo
+        """
+        lib, lib_version = cls._get_configured_library(library_file)
+        filename = cls._check_file(filename)
+        handle = cls._acquire_handle(library_file)
+        try:
+            if lib.MediaInfo_Open(handle, filename) == 0:
+                raise RuntimeError(
+                    "An eror occured while opening {0}" " with libmediainfo".format(filename)
+                )
+            res = {}
+            for kind, names in parameters.items():
+                kind_id = STREAM_KINDS[kind]
+                count = lib.MediaInfo_Count_Get(handle, kind_id, c_size_t(-1).value)
+                res[kind] = [
+                    {
+                        name: lib.MediaInfo_Get(handle, kind_id, i, name, _INFO_TEXT, _INFO_NAME)
+                        or None
+                        for name in names
+                    }
+                    for i in range(count)
+                ]
+            return res
+        finally:
+            cls._release_handle(handle, library_file)
+
     @classmethod
     def can_parse(cls, library_file=None):
         """
@@ -239,37 +372,8 @@ class MediaInfo(object):
         :raises RuntimeError: if parsing fails, this should not
             happen unless libmediainfo itself fails.
         """
-        lib = cls._get_library(library_file)
-        if pathlib is not None and isinstance(filename, pathlib.PurePath):
-            filename = str(filename)
-            url = False
-        else:
-            url = urlparse.urlparse(filename)
-        # Try to open the file (if it's not a URL)
-        # Doesn't work on Windows because paths are URLs
-        if not (url and url.scheme):
-            # Test whether the file is readable
-            with open(filename, "rb"):
-                pass
-        # Define arguments and return types
-        lib.MediaInfo_Inform.restype = c_wchar_p
-        lib.MediaInfo_New.argtypes = []
-        lib.MediaInfo_New.restype = c_void_p
-        lib.MediaInfo_Option.argtypes = [c_void_p, c_wchar_p, c_wchar_p]
-        lib.MediaInfo_Option.restype = c_wchar_p
-        lib.MediaInfo_Inform.argtypes = [c_void_p, c_size_t]
-        lib.MediaInfo_Inform.restype = c_wchar_p
-        lib.MediaInfo_Open.argtypes = [c_void_p, c_wchar_p]
-        lib.MediaInfo_Open.restype = c_size_t
-        lib.MediaInfo_Delete.argtypes = [c_void_p]
-        lib.MediaInfo_Delete.restype = None
-        lib.MediaInfo_Close.argtypes = [c_void_p]
-        lib.MediaInfo_Close.restype = None
-        # Obtain the library version
-        lib_version = lib.MediaInfo_Option(None, "Info_Version", "")
-        lib_version = tuple(
-            int(_) for _ in re.search("^MediaInfoLib - v(\\S+)", lib_version).group(1).split(".")
-        )
+        lib, lib_version = cls._get_configured_library(library_file)
+        filename = cls._check_file(filename)
         # The XML option was renamed starting with version 17.10
         if lib_version >= (17, 10):
             xml_option = "OLDXML"
@@ -279,9 +383,6 @@ class MediaInfo(object):
         # See https://github.com/MediaArea/MediaInfoLib/commit/d8fd88a1c282d1c09388c55ee0b46029e7330690
         if cover_data and lib_version >= (18, 3):
             lib.MediaInfo_Option(None, "Cover_Data", "base64")
-        # Create a MediaInfo handle
-        handle = lib.MediaInfo_New()
-        lib.MediaInfo_Option(handle, "CharSet", "UTF-8")
         # Fix for https://github.com/sbraz/pymediainfo/issues/22
         # Python 2 does not change LC_CTYPE
         # at startup: https://bugs.python.org/issue6203
@@ -289,14 +390,16 @@ class MediaInfo(object):
             locale.setlocale(locale.LC_CTYPE, locale.getdefaultlocale())
         lib.MediaInfo_Option(None, "Inform", xml_option)
         lib.MediaInfo_Option(None, "Complete", "1")
-        if lib.MediaInfo_Open(handle, filename) == 0:
-            raise RuntimeError(
-                "An eror occured while opening {0}" " with libmediainfo".format(filename)
-            )
-        xml = lib.MediaInfo_Inform(handle, 0)
-        # Delete the handle
-        lib.MediaInfo_Close(handle)
-        lib.MediaInfo_Delete(handle)
+        # Reuse an idle MediaInfo handle
+        handle = cls._acquire_handle(library_file)
+        try:
+            if lib.MediaInfo_Open(handle, filename) == 0:
+                raise RuntimeError(
+                    "An eror occured while opening {0}" " with libmediainfo".format(filename)
+                )
+            xml = lib.MediaInfo_Inform(handle, 0)
+        finally:
+            cls._release_handle(handle, library_file)
         return cls(xml, encoding_errors)
 
     def _populate_tracks(self):
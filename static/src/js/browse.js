@@ -12,7 +12,10 @@ var Browse = AbstractAction.extend({
     events: {
         'click .oov_folder': '_onClickFolder',
         'click .oov_media': '_onClickPlayMedia',
+        'click .oov_more': '_onClickMore',
     },
+    // Number of entries requested at once
+    limit: 200,
 
     init: function (parent, action) {
         this._super.apply(this, arguments);
@@ -41,19 +44,62 @@ var Browse = AbstractAction.extend({
         if (this.folder_data[this.folder_id]) {
             return $.when();
         } else {
-            return this._rpc({
-                    model: 'oovideo.folder',
-                    method: 'oovideo_browse',
-                    args: [self.folder_id],
-                })
-                .then(function (data) {
-                    var tmp_data = {};
-                    tmp_data[self.folder_id] = JSON.parse(data);
-                    _.extend(self.folder_data, tmp_data);
-                });
+            return this._fetch(0).then(function (data) {
+                var tmp_data = {};
+                tmp_data[self.folder_id] = data;
+                _.extend(self.folder_data, tmp_data);
+            });
         }
     },
 
+    /**
+     * Return true if the folder contains more entries than the ones loaded.
+     *
+     * @returns {Boolean}
+     */
+    hasMore: function () {
+        var data = this.folder_data[this.folder_id];
+        return data.child_ids.length + data.media_ids.length < data.child_count + data.media_count;
+    },
+
+    /**
+     * Load the next entries of the folder, and render them.
+     *
+     * @returns {Promise}
+     */
+    loadMore: function () {
+        var self = this;
+        var data = this.folder_data[this.folder_id];
+        return this._fetch(data.child_ids.length + data.media_ids.length).then(function (next) {
+            data.child_ids = data.child_ids.concat(next.child_ids);
+            data.media_ids = data.media_ids.concat(next.media_ids);
+            self.$el.html(QWeb.render('oovideo.Browse', {widget: self}));
+        });
+    },
+
+    //--------------------------------------------------------------------------
+    // Private
+    //--------------------------------------------------------------------------
+
+    /**
+     * Request a page of entries of the folder.
+     *
+     * @private
+     * @param {Number} offset number of entries to skip
+     * @returns {Promise} resolved with the listing of the folder
+     */
+    _fetch: function (offset) {
+        return this._rpc({
+                model: 'oovideo.folder',
+                method: 'oovideo_browse',
+                args: [this.folder_id],
+                kwargs: {offset: offset, limit: this.limit},
+            })
+            .then(function (data) {
+                return JSON.parse(data);
+            });
+    },
+
     //--------------------------------------------------------------------------
     // Handlers
     //--------------------------------------------------------------------------
@@ -65,12 +111,16 @@ var Browse = AbstractAction.extend({
             tag: 'oovideo_browse',
             name: _t('Browse Files'),
             context: {
-                folder_id: $(ev.target).data('id'),
+                folder_id: $(ev.currentTarget).data('id'),
                 folder_data: this.folder_data,
             },
         });
     },
 
+    _onClickMore: function (ev) {
+        this.loadMore();
+    },
+
     _onClickPlayMedia: function (ev) {
         this.do_action({
             type: 'ir.actions.client',
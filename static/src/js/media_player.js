@@ -13,6 +13,7 @@ var MediaPlayer = AbstractAction.extend({
         'click .oov_folder': '_onClickFolder',
         'click .oov_reload': '_onClickReload',
         'change .oov_raw': '_onChangeRaw',
+        'change .oov_res': '_toggleBitrate',
     },
 
     init: function (parent, action) {
@@ -38,8 +39,8 @@ var MediaPlayer = AbstractAction.extend({
         // Render now, since events don't work when using the 'template' attribute.
         this.$el.html(QWeb.render('oovideo.MediaPlayer', {widget: this}));
         this._initPlaybackData();
-        this._initClappr();
-        return this._super.apply(this, arguments);
+        var def = this._loadPlayback({});
+        return Promise.all([def, this._super.apply(this, arguments)]);
     },
 
     //--------------------------------------------------------------------------
@@ -49,16 +50,83 @@ var MediaPlayer = AbstractAction.extend({
     _initPlaybackData: function () {
         this.bitrate = _.contains(this.media_info.br_list, 500) ? 500 : this.media_info.br_list[0];
         this.$('.oov_br').val(String(this.bitrate))
-        this.resolution = _.contains(this.media_info.res_list, '360p') ? '360p' : 'orig';
+        if (_.contains(this.media_info.res_list, 'auto')) {
+            this.resolution = 'auto';
+        } else {
+            this.resolution = _.contains(this.media_info.res_list, '360p') ? '360p' : 'orig';
+        }
         this.$('.oov_res').val(this.resolution !== 'orig' ? this.resolution : this.media_info.res_list[0])
+        this._toggleBitrate();
         this.lang = this.media_info.audio_tracks_lang && this.media_info.audio_tracks_lang[0] || '0';
         this.$('.oov_lang').val(this.lang);
     },
 
+    /**
+     * Containers and codecs which the browser declares it can play. The containers are named as
+     * the formats of the media, and the codecs as expected by `oovideo_playback`.
+     *
+     * @returns {string[]}
+     */
+    _getCapabilities: function () {
+        var video = document.createElement('video');
+        var types = {
+            mp4: 'video/mp4',
+            m4v: 'video/mp4',
+            mov: 'video/quicktime',
+            mkv: 'video/x-matroska',
+            webm: 'video/webm',
+            h264: 'video/mp4; codecs="avc1.42E01E"',
+            hevc: 'video/mp4; codecs="hvc1.1.6.L93.B0"',
+            vp8: 'video/webm; codecs="vp8"',
+            vp9: 'video/webm; codecs="vp9"',
+            av1: 'video/mp4; codecs="av01.0.05M.08"',
+            aac: 'video/mp4; codecs="mp4a.40.2"',
+            mp3: 'audio/mpeg',
+            opus: 'audio/webm; codecs="opus"',
+            vorbis: 'audio/webm; codecs="vorbis"',
+        };
+        return _.filter(_.keys(types), function (key) {
+            return video.canPlayType(types[key]) !== '';
+        });
+    },
+
+    /**
+     * Ask the server for the cheapest way to play the media, then (re)start the player.
+     *
+     * @param {Object} params bitrate, resolution and language requested, if any
+     * @returns {Promise}
+     */
+    _loadPlayback: function (params) {
+        var self = this;
+        return this._rpc({
+                model: 'oovideo.media',
+                method: 'oovideo_playback',
+                args: [self.media_id, self._getCapabilities()],
+                kwargs: params,
+            })
+            .then(function (playback) {
+                self.playback = playback;
+                self.$('.oov_mode').text(self._getModeLabel(playback.mode));
+                if (self.player) {
+                    self.player.destroy();
+                }
+                self._initClappr();
+            });
+    },
+
+    _getModeLabel: function (mode) {
+        return {
+            direct: _t('Direct Play'),
+            remux: _t('Direct Stream'),
+            transcode: _t('Transcode'),
+        }[mode] || mode;
+    },
+
     _initClappr: function () {
         this.playerElement = this.$('#player-wrapper');
         this.player = new Clappr.Player({
             source: this._makeSourceURL(),
+            mimeType: this.raw ? undefined : this.playback.mimetype,
             autoPlay: true,
             chromeless: this.media_info.sub_list.length > 0 ? true : false,
             playback: {
@@ -71,13 +139,91 @@ var MediaPlayer = AbstractAction.extend({
 
         });
         this.player.attachTo(this.playerElement[0]);
+        this._initPreview();
+    },
+
+    /**
+     * Show the thumbnail of the hovered position on the seek bar, thanks to the preview track
+     * generated by the server.
+     */
+    _initPreview: function () {
+        var self = this;
+        if (!this.media_info.preview || this.previewInitialized) {
+            return;
+        }
+        this.previewInitialized = true;
+        var baseURL = this.media_info.preview.replace(/[^/]*$/, '');
+        $.get(this.media_info.preview).then(function (vtt) {
+            self.previewCues = self._parsePreview(vtt);
+        });
+        var $thumb = $('<div class="oov_preview"/>').hide().appendTo(this.playerElement);
+        this.playerElement.on('mousemove', '.bar-container[data-seekbar]', function (ev) {
+            var $bar = $(ev.currentTarget);
+            var ratio = (ev.pageX - $bar.offset().left) / $bar.width();
+            var time = ratio * self.player.getDuration();
+            var cue = _.find(self.previewCues || [], function (c) {
+                return c.start <= time && time < c.end;
+            });
+            if (!cue) {
+                $thumb.hide();
+                return;
+            }
+            var left = ev.pageX - self.playerElement.offset().left - cue.w / 2;
+            $thumb.css({
+                'background-image': 'url("' + baseURL + cue.url + '")',
+                'background-position': -cue.x + 'px ' + -cue.y + 'px',
+                width: cue.w,
+                height: cue.h,
+                left: Math.max(0, Math.min(left, self.playerElement.width() - cue.w)),
+                bottom: 60,
+            }).show();
+        });
+        this.playerElement.on('mouseleave', '.bar-container[data-seekbar]', function () {
+            $thumb.hide();
+        });
+    },
+
+    /**
+     * @param {string} vtt preview track
+     * @returns {Object[]} cues, with their time range and their area in the sprite
+     */
+    _parsePreview: function (vtt) {
+        var parseTime = function (str) {
+            var parts = str.trim().split(':');
+            return parseInt(parts[0]) * 3600 + parseInt(parts[1]) * 60 + parseFloat(parts[2]);
+        };
+        var cues = [];
+        var lines = vtt.split(/\r?\n/);
+        for (var i = 0; i < lines.length - 1; i++) {
+            if (lines[i].indexOf('-->') === -1) {
+                continue;
+            }
+            var times = lines[i].split('-->');
+            var target = lines[i + 1].split('#xywh=');
+            var xywh = (target[1] || '').split(',').map(Number);
+            cues.push({
+                start: parseTime(times[0]),
+                end: parseTime(times[1]),
+                url: target[0],
+                x: xywh[0], y: xywh[1], w: xywh[2], h: xywh[3],
+            });
+        }
+        return cues;
+    },
+
+    /**
+     * The bitrate is chosen by the player when the resolution is automatic.
+     */
+    _toggleBitrate: function () {
+        var disabled = this.$('.oov_raw').is(':checked') || this.$('.oov_res').val() === 'auto';
+        this.$('.oov_br').attr('disabled', disabled);
     },
 
     _makeSourceURL: function () {
-        return '/oovideo/stream/' + String(this.media_id) + (this.raw ? '.mp4' : '.m3u8')
-            + '?br=' + String(this.bitrate)
-            + '&res=' + this.resolution
-            + '&lang=' + this.lang.split(':')[0];
+        if (this.raw) {
+            return '/oovideo/stream/' + String(this.media_id) + '.mp4';
+        }
+        return this.playback.url;
     },
 
     //--------------------------------------------------------------------------
@@ -102,8 +248,17 @@ var MediaPlayer = AbstractAction.extend({
         this.resolution = this.resolution !== this.media_info.res_list[0] ? this.resolution : 'orig';
         this.lang = this.$('.oov_lang').val();
         this.raw = this.$('.oov_raw').is(':checked');
-        this.player.destroy();
-        this._initClappr();
+        if (this.raw) {
+            this.$('.oov_mode').text(this._getModeLabel('direct'));
+            this.player.destroy();
+            this._initClappr();
+            return;
+        }
+        this._loadPlayback({
+            br: String(this.bitrate),
+            res: this.resolution,
+            lang: this.lang.split(':')[0],
+        });
     },
 
     _onChangeRaw: function (ev) {
@@ -111,6 +266,7 @@ var MediaPlayer = AbstractAction.extend({
             this.$('.oov_br,.oov_res,.oov_lang').attr('disabled', true);
         } else {
             this.$('.oov_br,.oov_res,.oov_lang').removeAttr('disabled');
+            this._toggleBitrate();
         }
     },
 